@@ -10,9 +10,11 @@ import os
 import sys
 import requests
 import zipfile
-import io
+import tempfile
+import shutil
 import argparse
 from pathlib import Path
+import geopandas as gpd
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -20,6 +22,15 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 project_root = str(Path(__file__).parent.parent)
 sys.path.append(project_root)
 
+from src.http_session import SESSION
+
+# Size of the chunks read from the HTTP response
+CHUNK_SIZE = 1024 * 1024
+# Timeout in seconds of the download requests
+DOWNLOAD_TIMEOUT = 30
+# Size above which the downloaded zip file is spooled to disk
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
 def download_natural_earth_land(output_dir : str):
     """
     Download Natural Earth land polygons at 1:110m scale.
@@ -45,18 +56,42 @@ def download_natural_earth_land(output_dir : str):
         headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         }
-        response = requests.get(url, headers=headers)
-        # Check if the request was successful
-        response.raise_for_status()
-        
-        # Extract the zip file
-        with zipfile.ZipFile(io.BytesIO(response.content)) as z:
-            z.extractall(output_dir)
+        with SESSION.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            # Check if the request was successful
+            response.raise_for_status()
+            
+            # Stream the zip file to a spooled temporary file instead of buffering it in memory
+            # (the raw stream is decoded in case the server applies a gzip transfer encoding)
+            response.raw.decode_content = True
+            with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as tmp:
+                shutil.copyfileobj(response.raw, tmp, length=CHUNK_SIZE)
+                
+                # Check that the whole archive was received. Content-Length is the size of the
+                # encoded body, so it can only be compared when no content encoding was applied
+                expected_size = int(response.headers.get('Content-Length', 0))
+                if expected_size and not response.headers.get('Content-Encoding') and tmp.tell() != expected_size:
+                    logging.error(f"Incomplete download: received {tmp.tell()} of {expected_size} bytes")
+                    return False
+                tmp.seek(0)
+                
+                # Check the CRC of every member before extracting the zip file
+                with zipfile.ZipFile(tmp) as z:
+                    corrupt_member = z.testzip()
+                    if corrupt_member is not None:
+                        logging.error(f"Corrupt file in the downloaded archive: {corrupt_member}")
+                        return False
+                    z.extractall(output_dir)
         
         # Check if the shapefile exists
         shapefile = os.path.join(output_dir, 'ne_110m_land.shp')
         if os.path.exists(shapefile):
             logging.info(f"Successfully downloaded and extracted land polygons to {shapefile}")
+            
+            # Convert the shapefile to GeoParquet, which is faster to load
+            parquet_file = os.path.join(output_dir, 'ne_110m_land.parquet')
+            land_polygons = gpd.read_file(shapefile, engine='pyogrio', use_arrow=True)
+            land_polygons.to_parquet(parquet_file, compression='zstd')
+            logging.info(f"Converted land polygons to {parquet_file}")
             return True
         else:
             logging.error(f"Error: Shapefile not found after extraction")
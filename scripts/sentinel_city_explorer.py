@@ -7,15 +7,23 @@ modules to select geographically dispersed cities and query Sentinel-2 data for
 """
 
 import argparse
+import hashlib
+import io
 import os
-import json
+import orjson
 from datetime import datetime
 import sys
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import random
 import numpy as np
+import pandas as pd
 import logging
-from shapely.geometry import Polygon, Point # type: ignore
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import shapely # type: ignore
+from shapely.geometry import Polygon # type: ignore
+from shapely.strtree import STRtree # type: ignore
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -23,9 +31,24 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 project_root = str(Path(__file__).parent.parent)
 sys.path.append(project_root)
 
-from src.city_selector import load_city_data, select_dispersed_cities
-from src.sentinel_query import query_sentinel2_by_coordinates, get_random_point_at_distance, is_point_on_land
-from src.token_manager import get_access_token
+from src.city_selector import load_city_data, select_dispersed_cities, SELECTION_VERSION
+from src.sentinel_query import query_sentinel2_by_coordinates, get_random_point_at_distance, get_random_points_at_distance, are_points_on_land, parse_tile_id
+from src.token_manager import get_access_token, can_get_token_without_prompt
+
+# Maximum number of cities queried concurrently
+MAX_CITY_WORKERS = 16
+
+# Options of the unified JSON output. City coordinates come from pandas and may be NumPy scalars
+JSON_OPTIONS = orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY
+
+# Prepared city tile footprints, keyed by tile ID
+_PREPARED_CITY_POLYGONS = {}
+
+# Directory of the city selections cached between runs
+CITY_CACHE_DIR = Path(project_root) / "cache"
+
+# Number of random points tried outside the city tile, each with up to --max-land-attempts tries to fall on land
+CITY_POLYGON_ATTEMPTS = 20
 
 def setup_random_seed(seed : int =None):
     """Set up random seed for reproducibility
@@ -34,20 +57,15 @@ def setup_random_seed(seed : int =None):
         seed : Random seed value. If None, a random seed will be generated.
 
     Returns:
-        int: The random seed used.
+        A tuple containing the random seed used and a NumPy random generator seeded with it.
     """
     if seed is not None:
-        random.seed(seed)
-        np.random.seed(seed)
         logging.info(f"Set random seed to {seed}")
     else:
         # If no seed provided, generate one and use it
-        random_seed = random.randint(0, 2**32 - 1)
-        random.seed(random_seed)
-        np.random.seed(random_seed)
-        logging.info(f"Using generated random seed: {random_seed}")
-        return random_seed
-    return seed
+        seed = random.randint(0, 2**32 - 1)
+        logging.info(f"Using generated random seed: {seed}")
+    return seed, np.random.default_rng(seed)
 
 def parse_arguments():
     """Parse command line arguments
@@ -76,6 +94,8 @@ def parse_arguments():
                         help="Minimum distance between cities in kilometers (default: 500)")
     parser.add_argument("--random-seed", type=int, default=None,
                         help="Random seed for reproducible results")
+    parser.add_argument("--no-cache", action="store_true", default=False,
+                        help="Select the cities again instead of reusing the cached selection of a previous run, and refresh the cache (default: False)")
     
     args=  parser.parse_args()
 
@@ -114,13 +134,27 @@ def parse_arguments():
 
     return args
 
+def _extract_footprint(original_feature : dict):
+    """Extract the exterior ring of a product footprint
+    
+    Parameters:
+        original_feature : The product, with a restoGeometry or a standard GeoJSON geometry
+    Returns:
+        An (N, 2) array of the (lon, lat) coordinates of the footprint, or None if the product has no polygon footprint
+    """
+    # First try direct restoGeometry, then standard geometry
+    geom = original_feature.get('restoGeometry') or original_feature.get('geometry')
+    if not geom or geom.get('type') != 'Polygon' or 'coordinates' not in geom:
+        return None
+    return np.asarray(geom['coordinates'][0], dtype=np.float64)
+
 def get_city_tile_info(result: dict):
     """Extract tile ID, coordinates and footprint information from query result
     
     Parameters:
         result : The query result containing areas and products
     Returns:
-        A tuple containing the city tile ID, coordinates of the city footprint, and a boolean indicating if the footprint was found
+        A tuple containing the city tile ID, (lon, lat) coordinates of the city footprint, and a boolean indicating if the footprint was found
     """
     # Check if the result contains areas
     if not result or 'areas' not in result or not result['areas']:
@@ -128,137 +162,204 @@ def get_city_tile_info(result: dict):
     
     # Extract the first area from the result
     area = result['areas'][0]
-    city_tile_id = None
-    coords = []
-    city_footprint_found = False
+    coords = None
     
-    # Get the tile ID if present
+    # Get the tile ID and the product with a footprint, if present, in a single pass
+    city_tile_id = None
+    original_feature = None
     for product in area.get('quarterlyProducts', []):
-        if 'Name' in product:
-            parts = product['Name'].split('_')
-            if len(parts) >= 5:
-                city_tile_id = parts[4]
-                break
-    
-    # Get the footprint coordinates if available
-    original_feature = next((p for p in area.get('quarterlyProducts', []) if 'restoGeometry' in p), None)
+        if city_tile_id is None:
+            name = product.get('Name')
+            if name:
+                city_tile_id = parse_tile_id(name)
+        if original_feature is None and 'restoGeometry' in product:
+            original_feature = product
+        if city_tile_id is not None and original_feature is not None:
+            break
     
     if original_feature:
-        # First try direct restoGeometry
-        if 'restoGeometry' in original_feature:
-            geom = original_feature['restoGeometry']
-            if 'type' in geom and geom['type'] == 'Polygon' and 'coordinates' in geom:
-                geometry_coords = geom['coordinates'][0]
-                # Convert from [lon, lat] to [lat, lon] for compatibility
-                coords = [(coord[1], coord[0]) for coord in geometry_coords]
-                city_footprint_found = True
-        # Then try standard geometry
-        elif 'geometry' in original_feature and original_feature['geometry']['type'] == 'Polygon':
-            geometry_coords = original_feature['geometry']['coordinates'][0]
-            coords = [(coord[1], coord[0]) for coord in geometry_coords]
-            city_footprint_found = True
-    
-    return city_tile_id, coords, city_footprint_found
-
-def generate_random_point(lat : float, lon: float, args, city_polygon: Polygon=None):
+        coords = _extract_footprint(original_feature)
+    
+    return city_tile_id, coords, coords is not None
+
+def get_prepared_city_polygon(city_tile_id : str, coords : list):
+    """Get the prepared footprint of a city tile, cached by tile ID
+    
+    Parameters:
+        city_tile_id : ID of the city tile, None to skip the cache
+        coords : (N, 2) array of the (lon, lat) coordinates of the tile footprint
+    Returns:
+        The footprint polygon, prepared in place
+    """
+    city_polygon = _PREPARED_CITY_POLYGONS.get(city_tile_id)
+    if city_polygon is None:
+        city_polygon = shapely.polygons(coords)
+        shapely.prepare(city_polygon)
+        if city_tile_id is not None:
+            _PREPARED_CITY_POLYGONS[city_tile_id] = city_polygon
+    return city_polygon
+
+def are_points_in_city_tile(city_polygon : Polygon, lons, lats):
+    """Check which points fall within a city tile footprint
+    
+    Parameters:
+        city_polygon : Prepared polygon of the city footprint, in (lon, lat) order
+        lons : Longitudes of the points
+        lats : Latitudes of the points
+    Returns:
+        Boolean array, True for the points within the city tile
+    """
+    lons = np.asarray(lons, dtype=np.float64)
+    lats = np.asarray(lats, dtype=np.float64)
+    
+    # Random points are usually far from the tile, so only the ones within its bounding box are tested against the footprint
+    min_lon, min_lat, max_lon, max_lat = city_polygon.bounds
+    in_bounds = (lons >= min_lon) & (lons <= max_lon) & (lats >= min_lat) & (lats <= max_lat)
+    in_tile = np.zeros(len(lons), dtype=bool)
+    if in_bounds.any():
+        in_tile[in_bounds] = shapely.contains_xy(city_polygon, lons[in_bounds], lats[in_bounds])
+    return in_tile
+
+def get_city_cache_file(args):
+    """Get the cache file of the city selection for the city CSV file and selection arguments
+    
+    Parameters:
+        args : Parsed command line arguments
+    Returns:
+        Path to the cached selection, keyed by the version of the selection algorithm, the CSV file (path, size and modification time) and the selection arguments
+    """
+    csv_stat = os.stat(args.cities_csv)
+    key = hashlib.sha256(
+        f"{SELECTION_VERSION}:{os.path.abspath(args.cities_csv)}:{csv_stat.st_size}:{csv_stat.st_mtime_ns}:"
+        f"{args.population_min}:{args.num_cities}:{args.min_city_distance}".encode()
+    ).hexdigest()[:16]
+    return CITY_CACHE_DIR / f"selected_{key}.parquet"
+
+def generate_random_point(lat : float, lon: float, args, city_log : io.StringIO, city_polygon: Polygon=None, rng : np.random.Generator =None):
     """Generate a random point at the specified distance from the city
     
     Parameters:
         lat : Latitude of the city
         lon : Longitude of the city
         args : Parsed command line arguments
-        city_polygon : Polygon representing the city footprint
+        city_log : Buffer of the progress of the city, the messages are written to it
+        city_polygon : Prepared polygon of the city footprint, in (lon, lat) order
+        rng : Random number generator of the city
     Returns:
          A tuple containing the latitude, longitude, and a boolean indicating if the point is on land
     """
     # If we have a city polygon, try to find a point outside it
-    if city_polygon:
-        max_attempts = 20
-        found_valid_point = False
+    if city_polygon is not None:
+        # Draw all the candidate points at once, and test them against the land and the city tile footprint in bulk
+        num_candidates = CITY_POLYGON_ATTEMPTS * args.max_land_attempts
+        candidate_lats, candidate_lons = get_random_points_at_distance(lat, lon, args.random_distance, num_candidates, rng)
+        candidates_on_land = are_points_on_land(candidate_lats, candidate_lons)
+        valid = ~are_points_in_city_tile(city_polygon, candidate_lons, candidate_lats)
+        if args.ensure_on_land:
+            valid &= candidates_on_land
         
-        for attempt in range(max_attempts):
-            random_point_result = get_random_point_at_distance(
-                lat, lon, args.random_distance, 
-                ensure_on_land=args.ensure_on_land,
-                max_attempts=args.max_land_attempts
-            )
-            
-            if random_point_result is None:
-                continue
-                
-            random_lat, random_lon, is_on_land = random_point_result
-            
-            # Check if this point is outside the city tile footprint
-            if not city_polygon.contains(Point(random_lon, random_lat)):
-                found_valid_point = True
-                logging.info(f"Found valid random point outside the city tile after {attempt+1} attempts")
-                return random_point_result
+        # Keep the first valid candidate
+        idx = int(np.argmax(valid))
+        if valid[idx]:
+            city_log.write(f"Found valid random point outside the city tile after {idx+1} candidates\n")
+            return float(candidate_lats[idx]), float(candidate_lons[idx]), bool(candidates_on_land[idx])
         
-        if not found_valid_point:
-            logging.warning(f"Could not find a random point outside the city tile after {max_attempts} attempts.")
-            logging.warning(f"Falling back to standard random point generation.")
+        city_log.write(f"Could not find a random point outside the city tile after {num_candidates} candidates.\n")
+        city_log.write(f"Falling back to standard random point generation.\n")
     
     # Standard random point generation
     return get_random_point_at_distance(
         lat, lon, args.random_distance, 
         ensure_on_land=args.ensure_on_land,
-        max_attempts=args.max_land_attempts
+        max_attempts=args.max_land_attempts,
+        rng=rng
     )
 
-def process_city(city : dict, args, unified_result : dict):
+def process_city(city_name : str, lat : float, lon : float, args, seed : int):
     """Process a single city and its random point
     
     Parameters:
-        city : Dictionary containing city information
+        city_name : Name of the city
+        lat : Latitude of the city
+        lon : Longitude of the city
         args : Parsed command line arguments
-        unified_result : Dictionary to store the unified result
+        seed : Seed of the random number generator of the city, so that results don't depend on the order cities are processed in
     Returns:
-        A tuple containing the number of random points on land, in water, and skipped
+        A tuple containing the areas found serialized to JSON, their number of products, the (lat, lon) random point or None, and the number of random points on land, in water, and skipped
     """
-    lat, lon = city['lat'], city['lng']
-    city_name = city['city']
+    rng = np.random.default_rng(seed)
+    # The progress of the city is buffered and logged at once, so that concurrent cities don't interleave
+    city_log = io.StringIO()
+    areas = []
+    total_products = 0
 
     # Initialize city_polygon to None
     city_polygon = None
 
-
-    # Query for the city center
-    logging.info(f"\nCity: {city_name} ({lat}, {lon})")
-    result = query_sentinel2_by_coordinates(
-        lat=lat,
-        lon=lon,
-        year=args.year_filter,
-        output_dir=args.output_dir,
-        city_name=city_name,
-        city_lat=lat,
-        city_lon=lon,
-        is_neighbor=False
-    )
-    
-    # Process city result
-    city_tile_id = None
-    if result and 'areas' in result and result['areas']:
-        unified_result['areas'].extend(result['areas'])
-        unified_result['properties']['totalAreas'] += len(result['areas'])
-        unified_result['properties']['totalProducts'] += result['properties']['totalProducts']
+    city_log.write(f"\nCity: {city_name} ({lat}, {lon})\n")
+    
+    # Generate the random point before the city footprint is known, so that both queries overlap.
+    # It is checked against the footprint afterwards, and redrawn in the rare case it falls in the city tile.
+    # Its query has then already been sent: it still completes (the executor waits for it) and its result is discarded
+    city_log.write(f"\nGenerating random point {args.random_distance} km away from {city_name}...\n")
+    random_point_result = generate_random_point(lat, lon, args, city_log, None, rng)
+    
+    with ThreadPoolExecutor(max_workers=1) as query_executor:
+        random_future = None
+        if random_point_result is not None:
+            random_future = query_executor.submit(
+                query_sentinel2_by_coordinates,
+                lat=random_point_result[0],
+                lon=random_point_result[1],
+                year=args.year_filter,
+                output_dir=args.output_dir,
+                city_name=city_name,
+                city_lat=lat,
+                city_lon=lon,
+                is_neighbor=True
+            )
         
-        # Extract tile ID and footprint information
-        city_tile_id, coords, city_footprint_found = get_city_tile_info(result)
+        # Query for the city center
+        result = query_sentinel2_by_coordinates(
+            lat=lat,
+            lon=lon,
+            year=args.year_filter,
+            output_dir=args.output_dir,
+            city_name=city_name,
+            city_lat=lat,
+            city_lon=lon,
+            is_neighbor=False
+        )
         
-        # Create city polygon if footprint found
-        if city_footprint_found and coords:
-            city_polygon = Polygon(coords)
+        # Process city result
+        city_tile_id = None
+        # Areas are kept serialized, which is more compact than their dicts until the results are saved
+        if result and 'areas' in result and result['areas']:
+            areas.extend(orjson.dumps(area, option=JSON_OPTIONS) for area in result['areas'])
+            total_products += result['properties']['totalProducts']
+            
+            # Extract tile ID and footprint information
+            city_tile_id, coords, city_footprint_found = get_city_tile_info(result)
+            
+            # Create city polygon if footprint found
+            if city_footprint_found and len(coords) >= 3:
+                city_polygon = get_prepared_city_polygon(city_tile_id, coords)
         
-       
-    
-    # Generate random point
-    logging.info(f"\nGenerating random point {args.random_distance} km away from {city_name}...")
-    random_point_result = generate_random_point(lat, lon, args, city_polygon)
+        # Draw again outside the city tile if no point was found or it falls in the tile, whose query result is then ignored
+        if city_polygon is not None and (random_point_result is None
+                or are_points_in_city_tile(city_polygon, [random_point_result[1]], [random_point_result[0]])[0]):
+            if random_future is not None:
+                city_log.write(f"Random point is within the city tile, generating another one (its query is discarded)...\n")
+                random_future = None
+            random_point_result = generate_random_point(lat, lon, args, city_log, city_polygon, rng)
+        
+        random_result = random_future.result() if random_future is not None else None
     
     # Skip if no random point found
     if random_point_result is None:
+        logging.info(city_log.getvalue())
         logging.warning (f"Could not find a point on land after {args.max_land_attempts} attempts. Skipping random point for {city_name}.")
-        return 0, 0, 1  # on_land, in_water, skipped
+        return areas, total_products, None, 0, 0, 1  # on_land, in_water, skipped
     
     random_lat, random_lon, is_on_land = random_point_result
     
@@ -272,46 +373,62 @@ def process_city(city : dict, args, unified_result : dict):
         on_land = 0
         in_water = 1
         
-    logging.info(f"Random point {args.random_distance} km away: ({random_lat}, {random_lon}) - {land_status}")
-    
-    # Query Sentinel-2 data for the random point
-    neighborhood_size = 0.05 if city_tile_id else None
-    random_result = query_sentinel2_by_coordinates(
-        lat=random_lat,
-        lon=random_lon,
-        year=args.year_filter,
-        output_dir=args.output_dir,
-        city_name=city_name,
-        city_lat=lat,
-        city_lon=lon,
-        is_neighbor=True
-    )
+    city_log.write(f"Random point {args.random_distance} km away: ({random_lat}, {random_lon}) - {land_status}\n")
+    
+    # Query Sentinel-2 data for the random point, unless the query started with the city one is still valid
+    if random_result is None:
+        random_result = query_sentinel2_by_coordinates(
+            lat=random_lat,
+            lon=random_lon,
+            year=args.year_filter,
+            output_dir=args.output_dir,
+            city_name=city_name,
+            city_lat=lat,
+            city_lon=lon,
+            is_neighbor=True
+        )
     
     # Process random point result
     if random_result and 'areas' in random_result and random_result['areas']:
-        unified_result['areas'].extend(random_result['areas'])
-        unified_result['properties']['totalAreas'] += len(random_result['areas'])
-        unified_result['properties']['totalProducts'] += random_result['properties']['totalProducts']
+        areas.extend(orjson.dumps(area, option=JSON_OPTIONS) for area in random_result['areas'])
+        total_products += random_result['properties']['totalProducts']
     
-    return on_land, in_water, 0  # on_land, in_water, skipped
+    logging.info(city_log.getvalue())
+    return areas, total_products, (random_lat, random_lon), on_land, in_water, 0  # on_land, in_water, skipped
 
 
 
-def save_results(unified_result : dict, output_dir: str, year_filter: str):
-    """Save the unified result to a JSON file.
+def check_random_points_in_city_tiles(random_points : list):
+    """Check, all at once, if random points fall within the tile of a city once all cities are processed
+    
+    Parameters:
+        random_points : List of (city_name, lat, lon) random points
+    Returns:
+        Number of random points within a city tile
+    """
+    if not random_points or not _PREPARED_CITY_POLYGONS:
+        return 0
+    
+    # Index all the city tiles, and find the ones containing each random point
+    tile_ids = list(_PREPARED_CITY_POLYGONS)
+    tile_tree = STRtree(list(_PREPARED_CITY_POLYGONS.values()))
+    city_names, random_lats, random_lons = zip(*random_points)
+    point_indices, tile_indices = tile_tree.query(shapely.points(random_lons, random_lats), predicate='within')
+    for point_idx, tile_idx in zip(point_indices, tile_indices):
+        logging.warning(f"Random point of {city_names[point_idx]} is within the city tile {tile_ids[tile_idx]}")
+    return len(set(point_indices.tolist()))
+
+def get_unified_file(output_dir: Path, year_filter: str):
+    """Get the path of the unified JSON file of this run.
     
     Parameters:
-        unified_result : The unified result containing areas and properties
         output_dir : Directory to save the output file
         year_filter : Year filter used in the query
     Returns:
-        Path to the saved JSON file
+        Path to the unified JSON file
     """
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    unified_file = os.path.join(output_dir, f"S2_GlobalMosaics_{year_filter}_unified_{timestamp}.json")
-    with open(unified_file, 'w') as f:
-        json.dump(unified_result, f, indent=2)
-    return unified_file
+    return output_dir / f"S2_GlobalMosaics_{year_filter}_unified_{timestamp}.json"
 
 
 
@@ -328,43 +445,57 @@ def main():
         sys.exit(1)
 
     # Set up random seed
-    random_seed = setup_random_seed(args.random_seed)
-    
-    # Refresh token
-    logging.info("Refreshing token before starting")
-    refreshed = get_access_token()
-    if refreshed:
-        logging.info("Token refreshed successfully")
+    random_seed, rng = setup_random_seed(args.random_seed)
+    
+    # Build the output paths from a single Path
+    out_dir = Path(args.output_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    
+    # Check the token in the background while the cities are loaded and selected, it is only refreshed if it expires soon.
+    # If the credentials must be asked for, the token is fetched right away so that the prompt isn't mixed with the selection logs
+    logging.info("Checking token before starting")
+    token_executor = ThreadPoolExecutor(max_workers=1)
+    if can_get_token_without_prompt():
+        token_future = token_executor.submit(get_access_token)
     else:
-        logging.warning("Failed to refresh token. Will try to generate a new one when needed.")
+        token_future = None
+        refreshed = get_access_token()
     
-    # Load and select cities
+    # Load and select cities, reusing the selection of a previous run with the same inputs
     logging.info("\n=== Step 1: Loading and selecting cities ===")
-    cities_df = load_city_data(args.cities_csv, args.population_min)
-    if cities_df.empty:
-        logging.error("No cities found.")
-        sys.exit(1)
+    city_cache_file = get_city_cache_file(args)
+    if city_cache_file.exists() and not args.no_cache:
+        logging.info(f"Loading cached city selection from {city_cache_file}")
+        selected_cities = pd.read_parquet(city_cache_file, engine='pyarrow')
+    else:
+        cities_df = load_city_data(args.cities_csv, args.population_min)
+        if cities_df.empty:
+            logging.error("No cities found.")
+            sys.exit(1)
 
-    selected_cities = select_dispersed_cities(
-        cities_df, 
-        args.num_cities,
-        min_distance_km=args.min_city_distance
-    )
+        selected_cities = select_dispersed_cities(
+            cities_df, 
+            args.num_cities,
+            min_distance_km=args.min_city_distance
+        )
+        if not selected_cities.empty:
+            CITY_CACHE_DIR.mkdir(exist_ok=True)
+            selected_cities.to_parquet(city_cache_file, engine='pyarrow', compression='zstd', index=False)
     if selected_cities.empty:
         logging.error("No cities found that meet the criteria.")
         sys.exit(1)
 
     logging.info(f"Selected {len(selected_cities)} dispersed cities")
     
-    # Save selected cities to CSV
-    os.makedirs(args.output_dir, exist_ok=True)
-    selected_cities_file = os.path.join(args.output_dir, "selected_cities.csv")
-    selected_cities.to_csv(selected_cities_file, index=False)
-    logging.info(f"Selected cities saved to {selected_cities_file}")
+    # Save selected cities to CSV with the pyarrow writer, and to Parquet for downstream scripts
+    selected_cities_file = out_dir / "selected_cities.csv"
+    selected_cities_parquet = out_dir / "selected_cities.parquet"
+    pa_csv.write_csv(pa.Table.from_pandas(selected_cities, preserve_index=False), str(selected_cities_file))
+    selected_cities.to_parquet(selected_cities_parquet, engine='pyarrow', compression='zstd', index=False)
+    logging.info(f"Selected cities saved to {selected_cities_file} and {selected_cities_parquet}")
     
     # Initialize result structure
     unified_result = {
-        "areas": [],
         "properties": {
             "totalProducts": 0,
             "totalAreas": 0,
@@ -384,20 +515,65 @@ def main():
         }
     }
     
+    # Wait for the token before the first query
+    if token_future is not None:
+        refreshed = token_future.result()
+    token_executor.shutdown()
+    if refreshed:
+        logging.info("Token is valid")
+    else:
+        logging.warning("Failed to refresh token. Will try to generate a new one when needed.")
+    
     # Process each city
     logging.info("\n=== Step 2: Querying Sentinel-2 Global Mosaics data for each city ===")
+    random_points = []
     random_points_on_land = 0
     random_points_in_water = 0
     skipped_random_points = 0
-    
-    for _, city in selected_cities.iterrows():
-        on_land, in_water, skipped = process_city(city, args, unified_result)
-        random_points_on_land += on_land
-        random_points_in_water += in_water
-        skipped_random_points += skipped
-    
-    # Save results
-    unified_file = save_results(unified_result, args.output_dir, args.year_filter)
+    failed_cities = 0
+    
+    # Query the cities concurrently, each with its own random number generator seeded from the main one
+    # (the columns are read once as plain lists instead of boxing every row into a Series)
+    names = selected_cities['city'].tolist()
+    lats = selected_cities['lat'].tolist()
+    lons = selected_cities['lng'].tolist()
+    city_seeds = rng.integers(0, 2**32, size=len(names)).tolist()
+    # The areas of each city, already serialized, are written to the unified JSON file as soon as the city is done,
+    # and the properties last once all the totals are known
+    unified_file = get_unified_file(out_dir, args.year_filter)
+    with ThreadPoolExecutor(max_workers=min(MAX_CITY_WORKERS, len(names))) as executor, open(unified_file, 'wb') as f:
+        city_futures = [executor.submit(process_city, name, lat, lon, args, city_seed)
+                        for name, lat, lon, city_seed in zip(names, lats, lons, city_seeds)]
+        f.write(b'{"areas": [\n')
+        
+        # The array is always closed, so that the file stays valid JSON even if the merge is interrupted
+        try:
+            # Merge the results in the order of the selected cities, so that one failed city doesn't lose the others
+            for city_name, city_future in zip(names, city_futures):
+                try:
+                    areas, total_products, random_point, on_land, in_water, skipped = city_future.result()
+                except Exception as e:
+                    logging.error(f"Error processing {city_name}: {e}")
+                    failed_cities += 1
+                    continue
+                if areas:
+                    if unified_result['properties']['totalAreas']:
+                        f.write(b',\n')
+                    f.write(b',\n'.join(areas))
+                unified_result['properties']['totalAreas'] += len(areas)
+                unified_result['properties']['totalProducts'] += total_products
+                if random_point is not None:
+                    random_points.append((city_name, *random_point))
+                random_points_on_land += on_land
+                random_points_in_water += in_water
+                skipped_random_points += skipped
+        finally:
+            f.write(b'\n], "properties": ')
+            f.write(orjson.dumps(unified_result['properties'], option=JSON_OPTIONS))
+            f.write(b'}\n')
+    
+    # Check the random points against the tiles of all the cities, not only their own
+    random_points_in_city_tiles = check_random_points_in_city_tiles(random_points)
     
     # Print summary
     logging.info(f"\nSaved unified JSON with {unified_result['properties']['totalAreas']} areas and {unified_result['properties']['totalProducts']} products to {unified_file}")
@@ -417,19 +593,22 @@ def main():
         water_percent = 0
         skipped_percent = 0
     
-    print(f"\n=== Summary ===")
+    logging.info(f"\n=== Summary ===")
     logging.info(f"- Selected {len(selected_cities)} dispersed cities")
     logging.info(f"- Total Sentinel-2 Global Mosaic areas: {unified_result['properties']['totalAreas']}")
     logging.info(f"- Total Sentinel-2 Global Mosaic products: {unified_result['properties']['totalProducts']}")
     logging.info(f"- Random points on land: {random_points_on_land} ({land_percent:.1f}% of generated points)")
     logging.info(f"- Random points in water: {random_points_in_water} ({water_percent:.1f}% of generated points)")
     logging.info(f"- Random points skipped: {skipped_random_points} ({skipped_percent:.1f}% of attempted points)")
+    if random_points_in_city_tiles:
+        logging.warning(f"- Random points within a city tile: {random_points_in_city_tiles}")
+    if failed_cities:
+        logging.warning(f"- Cities that failed: {failed_cities}")
     logging.info(f"- Unified JSON saved to {unified_file}")
     
-    print(f"\n=== Process Complete ===")
+    logging.info(f"\n=== Process Complete ===")
     logging.info(f"You can now use the download_from_json.py script to download the tiles:")
     logging.info(f"python scripts/download_from_json.py --json-file {unified_file} --output-dir downloads")
-    print(f"\n")
     logging.info(f"To visualize the results, use visualize_quarterly_products.py:")
     logging.info(f"python scripts/visualize_quarterly_products.py --input-json {unified_file}")
     
@@ -7,7 +7,7 @@ quarterly products and their footprints.
 """
 
 import argparse
-import json
+import orjson
 import logging
 import os
 from datetime import datetime
@@ -33,8 +33,8 @@ def process_quarterly_products(json_file : str):
     Returns:
         List of results in the format expected by create_mosaic_map
     """
-    with open(json_file, 'r') as f:
-        data = json.load(f)
+    with open(json_file, 'rb') as f:
+        data = orjson.loads(f.read())
     
     results = []
     
@@ -74,6 +74,8 @@ def main():
                         help="Path to the JSON file containing quarterly products")
     parser.add_argument("--output-map", type=str, default="maps/quarterly_products_map.html",
                         help="Path to save the HTML map file")
+    parser.add_argument("--dynamic-load", action="store_true",
+                        help="Save tile footprints to a separate GeoJSON file and only display the ones in view (the map must be served over HTTP)")
     
     args = parser.parse_args()
     
@@ -83,7 +85,7 @@ def main():
     
     # Create the interactive map
     logging.info(f"Creating interactive map with {len(results)} areas")
-    create_mosaic_map(results, args.output_map)
+    create_mosaic_map(results, args.output_map, dynamic_load=args.dynamic_load)
     
     logging.info(f"\nMap saved to {args.output_map}")
 
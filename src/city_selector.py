@@ -12,6 +12,95 @@ import pandas as pd
 import logging
 import numpy as np
 from sklearn.metrics.pairwise import haversine_distances
+from sklearn.neighbors import BallTree
+
+# Columns read from the city CSV file and their types. Coordinates are kept in float64
+# since they are written as-is into the query results. The descriptive columns are only
+# carried into the selected cities files, and are skipped if the CSV file doesn't have them
+CITY_COLUMNS = {'city': str, 'city_ascii': str, 'lat': 'float64', 'lng': 'float64',
+                'country': str, 'iso2': str, 'iso3': str, 'admin_name': str, 'capital': str,
+                'population': 'float64'}
+
+# Earth radius in kilometers
+EARTH_RADIUS_KM = 6371.0
+
+# Safety margin applied to the approximate distances when shortlisting replacement candidates
+APPROXIMATION_MARGIN = 0.9
+
+# Number of candidates scanned at once when looking for a replacement city
+CANDIDATE_BLOCK_SIZE = 4096
+
+# Version of the selection algorithm, part of the key of the selections cached by the city explorer.
+# Bump it whenever a change to the selection can change the selected cities or their columns
+SELECTION_VERSION = 3
+
+def haversine_km(coords_rad, other_rad=None):
+    """
+    Calculate the haversine distances between two sets of points in one call.
+    
+    Args:
+        coords_rad : Array of shape (N, 2) with (lat, lng) in radians
+        other_rad : Array of shape (M, 2) with (lat, lng) in radians. If None, coords_rad is used
+        
+    Returns:
+        Array of shape (N, M) with the distances in kilometers
+    """
+    return EARTH_RADIUS_KM * haversine_distances(coords_rad, other_rad)
+
+def spherical_trig(coords_rad):
+    """
+    Precompute the per-point terms used by great_circle_km.
+    
+    Args:
+        coords_rad : Array of shape (N, 2) with (lat, lng) in radians
+        
+    Returns:
+        Array of shape (N, 3) with (sin(lat), cos(lat), lng)
+    """
+    return np.column_stack((np.sin(coords_rad[:, 0]), np.cos(coords_rad[:, 0]), coords_rad[:, 1]))
+
+def great_circle_km(trig, other_trig):
+    """
+    Calculate the great-circle distances between two sets of points with the spherical law of cosines.
+    
+    The latitude sines and cosines are precomputed by spherical_trig, so only one
+    cosine is evaluated per pair.
+    
+    Args:
+        trig : Array of shape (N, 3) returned by spherical_trig
+        other_trig : Array of shape (M, 3) returned by spherical_trig
+        
+    Returns:
+        Array of shape (N, M) with the distances in kilometers
+    """
+    cos_angle = (np.outer(trig[:, 0], other_trig[:, 0]) +
+                 np.outer(trig[:, 1], other_trig[:, 1]) * np.cos(trig[:, [2]] - other_trig[:, 2]))
+    return EARTH_RADIUS_KM * np.arccos(np.clip(cos_angle, -1.0, 1.0))
+
+def equirectangular_km(coords_rad, other_rad):
+    """
+    Approximate the distances between two sets of points with the equirectangular projection.
+    
+    This needs a single cosine per pair instead of the full haversine formula, and is
+    used to shortlist candidates before computing exact distances.
+    
+    Args:
+        coords_rad : Array of shape (N, 2) with (lat, lng) in radians
+        other_rad : Array of shape (M, 2) with (lat, lng) in radians
+        
+    Returns:
+        Array of shape (N, M) with the approximate distances in kilometers
+    """
+    lat, lng = coords_rad[:, [0]], coords_rad[:, [1]]
+    other_lat, other_lng = other_rad[:, 0], other_rad[:, 1]
+    
+    # Wrap longitude differences across the antimeridian
+    dlng = np.abs(lng - other_lng)
+    dlng = np.minimum(dlng, 2 * np.pi - dlng)
+    
+    dx = dlng * np.cos((lat + other_lat) / 2)
+    dy = lat - other_lat
+    return EARTH_RADIUS_KM * np.hypot(dx, dy)
 
 def load_city_data(csv_file : str, population_min : int =0):
     """
@@ -25,17 +114,70 @@ def load_city_data(csv_file : str, population_min : int =0):
         DataFrame containing filtered city data
     """
     logging.info(f"Loading city data from {csv_file}")
-    cities_df = pd.read_csv(csv_file)
+    cities_df = pd.read_csv(csv_file, usecols=lambda column: column in CITY_COLUMNS, dtype=CITY_COLUMNS, engine='c')
     
     # Filter by population if specified
     if population_min > 0:
         logging.info(f"Filtering cities with population >= {population_min}")
-        cities_df = cities_df[cities_df['population'] >= population_min]
+        cities_df = cities_df[cities_df['population'].to_numpy() >= population_min]
     
     logging.info(f"Loaded {len(cities_df)} cities")
     return cities_df
 
-def post_process_city_selection(selected_cities, all_cities, min_distance_km=500):
+def _find_replacement(all_rad32, all_trig, selected_mask, other_rad32, other_trig, min_distance_km, greedy=True):
+    """
+    Find the candidate city farthest from the other selected cities.
+    
+    Args:
+        all_rad32 : float32 (lat, lng) of all cities in radians
+        all_trig : Output of spherical_trig for all cities
+        selected_mask : Mask of the cities already in the selection
+        other_rad32 : float32 (lat, lng) of the selected cities that are kept, in radians
+        other_trig : Output of spherical_trig for the selected cities that are kept
+        min_distance_km : Minimum distance between cities in kilometers
+        greedy : If True, return the first candidate at least min_distance_km away from
+            the kept cities instead of scanning all candidates for the farthest one
+        
+    Returns:
+        (index, min_distance) of the replacement in all_cities, or (None, -inf) if there is no candidate
+    """
+    if greedy:
+        # Scan candidates block by block and stop at the first one satisfying the constraint
+        for start in range(0, len(selected_mask), CANDIDATE_BLOCK_SIZE):
+            block = slice(start, start + CANDIDATE_BLOCK_SIZE)
+            approx_distances = equirectangular_km(all_rad32[block], other_rad32).min(axis=1)
+            shortlist = np.flatnonzero(
+                (approx_distances >= APPROXIMATION_MARGIN * min_distance_km) & ~selected_mask[block]
+            )
+            if not shortlist.size:
+                continue
+            
+            candidate_distances = great_circle_km(all_trig[start + shortlist], other_trig).min(axis=1)
+            valid = np.flatnonzero(candidate_distances >= min_distance_km)
+            if valid.size:
+                return start + int(shortlist[valid[0]]), candidate_distances[valid[0]]
+        
+        # No candidate satisfies the constraint, fall back to the farthest one
+    
+    # Approximate minimum distance from every candidate to the kept cities
+    approx_distances = equirectangular_km(all_rad32, other_rad32).min(axis=1)
+    approx_distances[selected_mask] = -np.inf
+    top = int(np.argmax(approx_distances))
+    if selected_mask[top]:
+        return None, -np.inf
+    
+    # The approximation never underestimates the exact distance, so the farthest candidate
+    # has an approximate distance at least the exact distance of the top candidate by approximation
+    # (capped by its own approximation so that float32 rounding can't drop it from the shortlist)
+    top_distance = min(great_circle_km(all_trig[[top]], other_trig).min(), approx_distances[top])
+    shortlist = np.flatnonzero((approx_distances >= top_distance) & ~selected_mask)
+    
+    # Calculate exact minimum distances for the shortlisted candidates only
+    candidate_distances = great_circle_km(all_trig[shortlist], other_trig).min(axis=1)
+    best = int(np.argmax(candidate_distances))
+    return int(shortlist[best]), candidate_distances[best]
+
+def post_process_city_selection(selected_cities, all_cities, min_distance_km=500, greedy=True):
     """
     Post-process selected cities to ensure minimum distance between any pair.
     
@@ -43,33 +185,32 @@ def post_process_city_selection(selected_cities, all_cities, min_distance_km=500
         selected_cities: DataFrame of initially selected cities
         all_cities: DataFrame of all cities meeting population threshold
         min_distance_km: Minimum distance between cities in kilometers
+        greedy: If True, replace a city with the first candidate satisfying min_distance_km
+            instead of searching for the farthest candidate
         
     Returns:
         DataFrame of post-processed selected cities
     """
-    from math import radians, sin, cos, sqrt, atan2
+    # Positions of the selected cities within all_cities
+    selected_positions = all_cities.index.get_indexer(selected_cities.index)
     
-    def haversine_distance(lat1, lon1, lat2, lon2):
-        # Earth radius in kilometers
-        R = 6371.0
-        
-        # Convert degrees to radians
-        lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
-        
-        # Haversine formula
-        dlat = lat2 - lat1
-        dlon = lon2 - lon1
-        a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-        c = 2 * atan2(sqrt(a), sqrt(1-a))
-        distance = R * c
-        
-        return distance
+    # Mask of the cities in all_cities already in the selection
+    selected_mask = np.zeros(len(all_cities), dtype=bool)
+    selected_mask[selected_positions] = True
+    
+    # Extract the columns used below once, instead of indexing rows in the loop
+    all_rad = np.radians(all_cities[['lat', 'lng']].to_numpy(np.float64))
+    populations = all_cities['population'].to_numpy()
+    names = all_cities['city'].to_numpy(object)
     
-    # Create a copy of selected cities to modify
-    improved_cities = selected_cities.copy()
+    # The approximate shortlist only ranks candidates, so float32 is precise enough
+    # and halves the memory traffic of the largest distance matrix
+    all_rad32 = all_rad.astype(np.float32)
+    sel_rad32 = all_rad32[selected_positions]
     
-    # Create a set of indices of cities already in the selection
-    selected_indices = set(improved_cities.index)
+    # Precompute the latitude sines and cosines once for the exact distances
+    all_trig = spherical_trig(all_rad)
+    sel_trig = all_trig[selected_positions]
     
     # Track if any improvements were made
     improvements_made = True
@@ -77,76 +218,50 @@ def post_process_city_selection(selected_cities, all_cities, min_distance_km=500
     
     logging.info(f"Starting post-processing to ensure minimum distance of {min_distance_km} km between cities")
     
+    # Calculate distances between all pairs once, skipping self-comparisons.
+    # Replacements only update the row and column of the replaced city
+    distances_km = great_circle_km(sel_trig, sel_trig)
+    np.fill_diagonal(distances_km, np.inf)
+    
     while improvements_made:
         iteration += 1
         improvements_made = False
         
         # Find the closest pair of cities
-        min_dist = float('inf')
-        closest_pair = None
-        
-        # Calculate distances between all pairs
-        for i, city1 in improved_cities.iterrows():
-            for j, city2 in improved_cities.iterrows():
-                if i >= j:  # Skip self-comparisons and duplicates
-                    continue
-                
-                dist = haversine_distance(
-                    city1['lat'], city1['lng'],
-                    city2['lat'], city2['lng']
-                )
-                
-                # Check if this is the closest pair found so far
-                if dist < min_dist:
-                    min_dist = dist
-                    closest_pair = (i, j)
+        i, j = np.unravel_index(np.argmin(distances_km), distances_km.shape)
+        min_dist = distances_km[i, j]
         
         # If closest pair is too close, replace one of them
-        if min_dist < min_distance_km and closest_pair is not None:
-            logging.info(f"Iteration {iteration}: Found cities {improved_cities.loc[closest_pair[0]]['city']} and {improved_cities.loc[closest_pair[1]]['city']} only {min_dist:.1f} km apart")
+        if min_dist < min_distance_km:
+            city1, city2 = selected_positions[i], selected_positions[j]
+            logging.info(f"Iteration {iteration}: Found cities {names[city1]} and {names[city2]} only {min_dist:.1f} km apart")
             
             # Choose which city to replace (e.g., the less populous one)
-            city1_pop = improved_cities.loc[closest_pair[0]]['population']
-            city2_pop = improved_cities.loc[closest_pair[1]]['population']
-            
-            replace_idx = closest_pair[0] if city1_pop < city2_pop else closest_pair[1]
+            replace_idx = i if populations[city1] < populations[city2] else j
             
-            city_to_replace = improved_cities.loc[replace_idx]
-            logging.info(f"  Replacing {city_to_replace['city']} (pop: {city_to_replace['population']})")
+            city_to_replace = selected_positions[replace_idx]
+            logging.info(f"  Replacing {names[city_to_replace]} (pop: {populations[city_to_replace]})")
             
-            # Find the best replacement
-            best_replacement = None
-            max_min_distance = 0
-            
-            # Consider all cities not in the current selection
-            for idx, candidate in all_cities.iterrows():
-                if idx in selected_indices:
-                    continue
-                
-                # Calculate minimum distance to all other selected cities
-                min_distance = float('inf')
-                for _, selected_city in improved_cities.iterrows():
-                    if _ == replace_idx:  # Skip the city we're replacing
-                        continue
-                    
-                    dist = haversine_distance(
-                        candidate['lat'], candidate['lng'],
-                        selected_city['lat'], selected_city['lng']
-                    )
-                    min_distance = min(min_distance, dist)
-                
-                # If this candidate has a better minimum distance, update
-                if min_distance > max_min_distance:
-                    max_min_distance = min_distance
-                    best_replacement = candidate.copy()
-                    best_replacement_idx = idx
+            # Find a replacement among the cities not in the current selection
+            other_rad32 = np.delete(sel_rad32, replace_idx, axis=0)
+            other_trig = np.delete(sel_trig, replace_idx, axis=0)
+            best_replacement_idx, max_min_distance = _find_replacement(
+                all_rad32, all_trig, selected_mask, other_rad32, other_trig, min_distance_km, greedy
+            )
             
             # If we found a better replacement, use it
-            if best_replacement is not None and max_min_distance > min_dist:
-                logging.info(f"  Replaced with {best_replacement['city']} (min distance: {max_min_distance:.1f} km)")
-                improved_cities.loc[replace_idx] = best_replacement
-                selected_indices.remove(replace_idx)
-                selected_indices.add(best_replacement_idx)
+            if best_replacement_idx is not None and max_min_distance > min_dist:
+                logging.info(f"  Replaced with {names[best_replacement_idx]} (min distance: {max_min_distance:.1f} km)")
+                selected_mask[city_to_replace] = False
+                selected_mask[best_replacement_idx] = True
+                selected_positions[replace_idx] = best_replacement_idx
+                sel_rad32[replace_idx] = all_rad32[best_replacement_idx]
+                sel_trig[replace_idx] = all_trig[best_replacement_idx]
+                
+                new_distances = great_circle_km(sel_trig, sel_trig[[replace_idx]]).ravel()
+                distances_km[replace_idx, :] = new_distances
+                distances_km[:, replace_idx] = new_distances
+                distances_km[replace_idx, replace_idx] = np.inf
                 improvements_made = True
             else:
                 logging.warning(f"  Could not find a better replacement, keeping original city")
@@ -155,7 +270,7 @@ def post_process_city_selection(selected_cities, all_cities, min_distance_km=500
             break
     
     logging.info(f"Post-processing complete after {iteration} iterations")
-    return improved_cities
+    return all_cities.iloc[selected_positions]
 
 def select_dispersed_cities(cities_df, n_cities : int =200, min_distance_km : int =500):
     """
@@ -175,52 +290,54 @@ def select_dispersed_cities(cities_df, n_cities : int =200, min_distance_km : in
     if 'lat' not in cities_df.columns or 'lng' not in cities_df.columns:
         raise ValueError("City data must contain 'lat' and 'lng' columns")
     
-    # Filter out cities with missing coordinates
-    valid_cities = cities_df.dropna(subset=['lat', 'lng']).copy()
+    # Filter out cities with missing coordinates and sort the rest by decreasing
+    # population, building the DataFrame once from the resulting positions
+    valid_positions = np.flatnonzero((cities_df['lat'].notna() & cities_df['lng'].notna()).to_numpy())
+    order = np.argsort(-cities_df['population'].to_numpy()[valid_positions], kind='stable')
+    valid_cities = cities_df.iloc[valid_positions[order]]
     logging.info(f"Found {len(valid_cities)} cities with valid coordinates")
     
     if len(valid_cities) < n_cities:
         logging.warning(f"Warning: Only {len(valid_cities)} cities available, less than requested {n_cities}")
         n_cities = len(valid_cities)
     
-    # Convert coordinates to radians for haversine distance calculation
-    coords_rad = np.radians(valid_cities[['lat', 'lng']].values)
+    # Convert coordinates to radians for haversine distance calculation, in the
+    # same order as valid_cities
+    coords_rad = np.radians(valid_cities[['lat', 'lng']].to_numpy(np.float64))
     
     # Start with the most populous city
-    valid_cities = valid_cities.sort_values('population', ascending=False)
-    selected_indices = [0]  # Start with the most populous city
-    
+    selected_indices = [0]
+
+    # Minimum distance from each city to any selected city
+    min_distances = haversine_km(coords_rad, coords_rad[[0]]).ravel()
+    min_distances[0] = -1  # Already selected
+
+    # Ball tree used to find the cities a newly selected city can get closer to
+    tree = BallTree(coords_rad, metric='haversine')
+
     # Greedy algorithm to select dispersed cities
     for i in range(1, n_cities):
-        selected_coords = coords_rad[selected_indices]
-        min_distances = []
-        
-        # Calculate minimum distance from each unselected city to any selected city
-        for j in range(len(valid_cities)):
-            if j in selected_indices:
-                min_distances.append(-1)  # Already selected
-                continue
-                
-            # Calculate haversine distances to all selected cities
-            city_coord = coords_rad[j].reshape(1, -1)
-            distances = haversine_distances(city_coord, selected_coords).flatten()
-            
-            # Convert from radians to kilometers (Earth radius ≈ 6371 km)
-            distances_km = 6371.0 * distances
-            
-            # Find minimum distance to any selected city
-            min_distances.append(np.min(distances_km))
-        
         # Select the city with the maximum minimum distance
-        next_city_idx = np.argmax(min_distances)
+        next_city_idx = int(np.argmax(min_distances))
         selected_indices.append(next_city_idx)
+
+        # Every city is already within this radius of the selected set, so only
+        # cities inside it can have their minimum lowered by the new city
+        radius_km = min_distances[next_city_idx]
+        neighbors, distances = tree.query_radius(
+            coords_rad[[next_city_idx]], r=radius_km / EARTH_RADIUS_KM, return_distance=True
+        )
+        neighbors, distances_km = neighbors[0], EARTH_RADIUS_KM * distances[0]
+        min_distances[neighbors] = np.minimum(min_distances[neighbors], distances_km)
+        min_distances[next_city_idx] = -1  # Already selected
     
-    # Get the selected cities
-    selected_cities = valid_cities.iloc[selected_indices].reset_index(drop=True)
+    # Get the selected cities, keeping their index so post-processing can
+    # locate them within valid_cities
+    selected_cities = valid_cities.iloc[selected_indices]
     
     # Always apply post-processing
     selected_cities = post_process_city_selection(
         selected_cities, valid_cities, min_distance_km
     )
     
-    return selected_cities 
\ No newline at end of file
+    return selected_cities.reset_index(drop=True) 
\ No newline at end of file
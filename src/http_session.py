@@ -0,0 +1,39 @@
+"""
+HTTP Session Module
+
+This module provides the HTTP session shared by the token, query and download
+requests to the Copernicus Data Space API, so that they reuse their connections.
+"""
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Number of hosts and of connections per host kept open
+POOL_CONNECTIONS = 16
+POOL_MAXSIZE = 32
+
+# Retry strategy for rate limiting and transient server errors, honoring the Retry-After header
+RETRY_STRATEGY = Retry(
+    total=5,
+    backoff_factor=0.5,
+    status_forcelist=[429, 502, 503, 504],
+    respect_retry_after_header=True,
+    raise_on_status=False
+)
+
+def create_session():
+    """
+    Create an HTTP session with connection pooling and retries.
+
+    Returns:
+        The configured requests session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=RETRY_STRATEGY)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# Session shared by all the modules
+SESSION = create_session()
@@ -0,0 +1,90 @@
+"""
+Land Index Module
+
+This module provides a cached spatial index of the Natural Earth land polygons,
+used to determine if points are on land or in water.
+"""
+
+import os
+import logging
+import functools
+import threading
+import warnings
+import numpy as np
+import shapely
+from shapely.strtree import STRtree
+import geopandas as gpd
+
+# Create data directory path
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+data_dir = os.path.join(project_root, 'data')
+os.makedirs(data_dir, exist_ok=True)
+
+# Cities are processed concurrently, the lock makes sure only the first thread loads the polygons
+_LAND_INDEX_LOCK = threading.Lock()
+
+@functools.lru_cache(maxsize=1)
+def _load_land_index():
+    """
+    Load the land polygons and build a spatial index over them.
+    
+    Returns:
+        STRtree of the prepared land polygons, or None if they could not be loaded
+    """
+    try:
+        ne_parquet = os.path.join(data_dir, 'ne_110m_land.parquet')
+        ne_file = os.path.join(data_dir, 'ne_110m_land.shp')
+        if os.path.exists(ne_parquet) or os.path.exists(ne_file):
+            # Prefer the GeoParquet copy made by download_land_polygons.py, then read the shapefile with pyogrio
+            if os.path.exists(ne_parquet):
+                logging.info(f"Loading land polygons from {ne_parquet}")
+                land_polygons = gpd.read_parquet(ne_parquet)
+            else:
+                logging.info(f"Loading land polygons from {ne_file}")
+                land_polygons = gpd.read_file(ne_file, engine='pyogrio', use_arrow=True)
+            land_geometries = land_polygons.geometry.to_numpy()
+            # Prepare the polygons in place so that point tests against them are faster
+            shapely.prepare(land_geometries)
+            return STRtree(land_geometries)
+        else:
+            warnings.warn("Land polygon file not found. Cannot determine if point is on land.")
+    except ImportError:
+        warnings.warn("Geopandas not installed. Cannot determine if point is on land.")
+    except FileNotFoundError:
+        warnings.warn("Land polygon file not found. Cannot determine if point is on land.")
+    except ValueError:
+        warnings.warn("Error parsing land polygon file. Cannot determine if point is on land.")
+    except Exception as e:
+        warnings.warn(f"Error loading land polygons: {e}. Cannot determine if point is on land.")
+    return None
+
+def get_land_index():
+    """
+    Get the spatial index of the land polygons, loading them on the first call.
+    
+    Returns:
+        STRtree of the prepared land polygons, or None if they could not be loaded
+    """
+    with _LAND_INDEX_LOCK:
+        return _load_land_index()
+
+def are_points_on_land(lats : np.ndarray, lons : np.ndarray):
+    """
+    Check if geographic points are on land or in water, all in one query.
+    
+    Args:
+        lats : Latitudes of the points
+        lons : Longitudes of the points
+        
+    Returns:
+        Boolean array, True for the points on land
+    """
+    on_land = np.zeros(len(lats), dtype=bool)
+    land_index = get_land_index()
+    if land_index is None:
+        return on_land
+    
+    # Indices of the points within a land polygon, the others are in water
+    point_indices, _ = land_index.query(shapely.points(lons, lats), predicate='within')
+    on_land[point_indices] = True
+    return on_land
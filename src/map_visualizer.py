@@ -6,12 +6,18 @@ Sentinel-2 data, including city locations and tile footprints.
 """
 
 import folium
-from folium.plugins import MeasureControl, MiniMap, MarkerCluster
-import random
+import orjson
+from branca.element import MacroElement
+from jinja2 import Template
+from folium.plugins import MeasureControl, MiniMap, FastMarkerCluster
 import os
+import gzip
+import zlib
 from shapely.geometry import Polygon, Point
 import math
 import logging
+import re
+import numpy as np
 
 def haversine_distance(point1, point2):
     """
@@ -37,427 +43,669 @@ def haversine_distance(point1, point2):
     r = 6371  # Radius of Earth in kilometers
     return c * r
 
-def create_mosaic_map(cities_results : list, output_file : str ='maps/city_mosaics_map.html'):
+# Matches a WKT polygon and captures the content of its outer parentheses
+_WKT_POLYGON = re.compile(r'^\s*POLYGON\s*\((.*)\)\s*$', re.IGNORECASE | re.DOTALL)
+
+# Marker (color, radius) keyed by (is_random_point, is_on_land, has_tiles).
+# Random points are green on land and blue in water, with a lighter shade when no tile was found
+MARKER_STYLES = {
+    (False, True, True): ('red', 5),
+    (False, True, False): ('red', 5),
+    (False, False, True): ('red', 5),
+    (False, False, False): ('red', 5),
+    (True, True, True): ('green', 4),
+    (True, True, False): ('lightgreen', 3),
+    (True, False, True): ('blue', 4),
+    (True, False, False): ('lightblue', 3),
+}
+
+# JavaScript building a circle marker from a [lat, lon, color, radius, popup] row
+CIRCLE_MARKER_CALLBACK = """
+function (row) {
+    var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {
+        color: row[2], fillColor: row[2], fill: true, fillOpacity: 0.7, radius: row[3]
+    });
+    marker.bindPopup(row[4]);
+    return marker;
+}
+"""
+
+# Colors of the city tiles, picked from a hash of the tile ID
+TILE_COLORS = ('blue', 'green', 'purple', 'orange', 'darkred', 'darkblue', 'darkgreen', 'cadetblue', 'darkpurple', 'pink')
+
+# Tolerance in degrees used to simplify tile footprints, well below a pixel at the default zoom
+FOOTPRINT_SIMPLIFY_TOLERANCE = 0.01
+
+# Number of decimals of the emitted coordinates, about 1 m, beyond which they add no visible detail
+COORDINATE_PRECISION = 5
+
+# Base maps shared by every generated map, as keyword arguments for folium.TileLayer
+BASE_LAYERS = (
+    dict(tiles='CartoDB positron', name='Light Map', control=True),
+    dict(tiles='CartoDB dark_matter', name='Dark Map', control=True),
+    dict(tiles='OpenStreetMap', name='OpenStreetMap', control=True),
+    # Satellite view
+    dict(tiles='https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
+         attr='Esri', name='Satellite', control=True, overlay=False),
+    # Hybrid satellite view with labels
+    dict(tiles='https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
+         attr='Esri', name='Satellite with Labels', control=True, overlay=False),
+    # Labels as an overlay for the hybrid view
+    dict(tiles='https://server.arcgisonline.com/ArcGIS/rest/services/Reference/World_Boundaries_and_Places/MapServer/tile/{z}/{y}/{x}',
+         attr='Esri', name='Labels', control=True, overlay=True, show=False),
+    # Terrain view
+    dict(tiles='https://server.arcgisonline.com/ArcGIS/rest/services/World_Terrain_Base/MapServer/tile/{z}/{y}/{x}',
+         attr='Esri', name='Terrain', control=True, overlay=False),
+)
+
+# Popup rows of the tiles and connection lines, as (property, label) pairs.
+# Popups are built by Leaflet from the feature properties when clicked, and empty properties are skipped
+TILE_POPUP_FIELDS = (
+    ('title', 'Title'),
+    ('distance_km', 'Distance to tile (km)'),
+    ('start_date', 'Start Date'),
+    ('product_type', 'Product Type'),
+    ('tile_id', 'Tile ID'),
+    ('quarterly_count', 'Quarterly Products'),
+    ('quarters', 'Quarters'),
+    ('city_name', 'Associated City'),
+    ('city_coordinates', 'City Coordinates'),
+    ('point_type', 'Point Type'),
+    ('download', 'Download'),
+)
+RANDOM_CONNECTION_POPUP_FIELDS = (('distance_km', 'Distance (km)'),)
+
+# JavaScript building a popup table from the non-empty properties of a feature, given a list of (property, label) pairs
+POPUP_TABLE_FUNCTION = """
+function (properties, fields) {
+    var rows = fields.filter(function (field) {
+        var value = properties[field[0]];
+        return value !== undefined && value !== null && value !== '';
+    }).map(function (field) {
+        return '<tr><th>' + field[1] + '</th><td>' + properties[field[0]] + '</td></tr>';
+    });
+    return '<table>' + rows.join('') + '</table>';
+}
+"""
+
+# Compression level of the gzipped copy of the saved maps
+GZIP_COMPRESS_LEVEL = 6
+
+# Options of the measurement tools
+MEASURE_CONTROL_OPTIONS = dict(
+    position='topleft',
+    primary_length_unit='kilometers',
+    secondary_length_unit='miles',
+    primary_area_unit='square kilometers',
+    secondary_area_unit='acres'
+)
+
+def _add_base_layers(m : folium.Map):
     """
-    Create an interactive map showing cities and their associated Sentinel-2 mosaic tiles.
+    Add the base maps, the minimap and the measurement tools to a map.
     
     Args:
-        cities_results : List of dictionaries containing query results for each city
-        output_file : Path to save the HTML map file
+        m : The map to add the layers to
+    """
+    for layer_options in BASE_LAYERS:
+        folium.TileLayer(**layer_options).add_to(m)
+    
+    m.add_child(MiniMap(toggle_display=True))
+    m.add_child(MeasureControl(**MEASURE_CONTROL_OPTIONS))
+
+def save_map(m : folium.Map, output_file : str):
+    """
+    Render a map once and save it as HTML, along with a gzipped copy that can be
+    served with "Content-Encoding: gzip".
+    
+    Args:
+        m : The map to save
+        output_file : Path of the HTML file, the gzipped copy is saved to output_file + '.gz'
+    """
+    html = m.get_root().render()
+    with open(output_file, 'w', encoding='utf-8') as f:
+        f.write(html)
+    with gzip.open(f"{output_file}.gz", 'wt', encoding='utf-8', compresslevel=GZIP_COMPRESS_LEVEL) as f:
+        f.write(html)
+
+def parse_wkt_polygon(footprint : str):
+    """
+    Parse the exterior ring of a WKT polygon.
+    
+    Args:
+        footprint : WKT string, e.g. "POLYGON((lon1 lat1, lon2 lat2, ...))"
         
     Returns:
-        Path to the saved HTML map file
+        List of [lat, lon] coordinates, or an empty list if the string can't be parsed
     """
-    logging.info(f"Creating interactive map with {len(cities_results)} cities and their Sentinel-2 tiles")
+    match = _WKT_POLYGON.match(footprint)
+    if not match:
+        return []
     
-    # Create a map centered at the average of all coordinates
-    valid_coords = [(r['lat'], r['lon']) for r in cities_results if r['count'] > 0]
+    # Keep the exterior ring and convert all its numbers in one call, which fails on any invalid number
+    ring = match.group(1).split(')')[0].lstrip(' (').replace(',', ' ')
+    try:
+        values = np.array(ring.split(), dtype=np.float64)
+    except ValueError:
+        return []
     
-    if not valid_coords:
-        logging.warning("No valid coordinates with Sentinel-2 data found")
-        return None
+    if values.size % 2:
+        return []
     
-    avg_lat = sum(lat for lat, _ in valid_coords) / len(valid_coords)
-    avg_lon = sum(lon for _, lon in valid_coords) / len(valid_coords)
+    # Convert from lon/lat to lat/lon for folium
+    return values.reshape(-1, 2)[:, ::-1].tolist()
+
+def simplify_footprint(coords : list, tolerance : float =FOOTPRINT_SIMPLIFY_TOLERANCE):
+    """
+    Simplify a footprint with the Douglas-Peucker algorithm to reduce the number of emitted vertices.
     
-    # Create a map with the default CartoDB positron tiles
-    m = folium.Map(location=[avg_lat, avg_lon], zoom_start=3, tiles=None)
+    Args:
+        coords : List of [lat, lon] points of the exterior ring
+        tolerance : Simplification tolerance in degrees
+        
+    Returns:
+        List of [lat, lon] points of the simplified ring, or coords if it can't be simplified
+    """
+    try:
+        simplified = Polygon([(lon, lat) for lat, lon in coords]).simplify(tolerance, preserve_topology=False)
+    except (ValueError, TypeError):
+        return coords
     
-    # Add different base maps
-    folium.TileLayer(
-        tiles='CartoDB positron',
-        name='Light Map',
-        control=True,
-    ).add_to(m)
-    
-    folium.TileLayer(
-        tiles='CartoDB dark_matter',
-        name='Dark Map',
-        control=True,
-    ).add_to(m)
-    
-    folium.TileLayer(
-        tiles='OpenStreetMap',
-        name='OpenStreetMap',
-        control=True,
-    ).add_to(m)
-    
-    # Add satellite view
-    folium.TileLayer(
-        tiles='https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
-        attr='Esri',
-        name='Satellite',
-        control=True,
-        overlay=False,
-    ).add_to(m)
-    
-    # Add a hybrid satellite view with labels
-    folium.TileLayer(
-        tiles='https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
-        attr='Esri',
-        name='Satellite with Labels',
-        control=True,
-        overlay=False,
-    ).add_to(m)
-    
-    # Add labels as an overlay for the hybrid view
-    folium.TileLayer(
-        tiles='https://server.arcgisonline.com/ArcGIS/rest/services/Reference/World_Boundaries_and_Places/MapServer/tile/{z}/{y}/{x}',
-        attr='Esri',
-        name='Labels',
-        control=True,
-        overlay=True,
-        show=False,
-    ).add_to(m)
-    
-    # Add a terrain view
-    folium.TileLayer(
-        tiles='https://server.arcgisonline.com/ArcGIS/rest/services/World_Terrain_Base/MapServer/tile/{z}/{y}/{x}',
-        attr='Esri',
-        name='Terrain',
-        control=True,
-        overlay=False,
-    ).add_to(m)
-    
-    # Add a minimap
-    minimap = MiniMap(toggle_display=True)
-    m.add_child(minimap)
-    
-    # Add measurement tools
-    measure_control = MeasureControl(
-        position='topleft',
-        primary_length_unit='kilometers',
-        secondary_length_unit='miles',
-        primary_area_unit='square kilometers',
-        secondary_area_unit='acres'
-    )
-    m.add_child(measure_control)
+    if simplified.is_empty or simplified.geom_type != 'Polygon':
+        return coords
+    return [[lat, lon] for lon, lat in simplified.exterior.coords]
+
+def _to_geojson_coords(points : list):
+    """
+    Convert [lat, lon] points to [lon, lat] GeoJSON coordinates rounded to COORDINATE_PRECISION.
     
-    # Create feature groups for better organization
-    city_group = folium.FeatureGroup(name="Cities")
-    random_point_group = folium.FeatureGroup(name="Random Points")
-    tile_group = folium.FeatureGroup(name="Sentinel-2 Tiles")
-    connection_group = folium.FeatureGroup(name="City-Tile Connections")
-    random_connection_group = folium.FeatureGroup(name="City-Random Point Connections")
+    Args:
+        points : List of [lat, lon] points
+        
+    Returns:
+        List of rounded [lon, lat] coordinates
+    """
+    return np.round(np.asarray(points, dtype=np.float64)[:, ::-1], COORDINATE_PRECISION).tolist()
+
+def _line_feature(locations : list, style : dict, properties : dict =None):
+    """
+    Build a GeoJSON LineString feature.
     
-    m.add_child(city_group)
-    m.add_child(random_point_group)
-    m.add_child(tile_group)
-    m.add_child(connection_group)
-    m.add_child(random_connection_group)
+    Args:
+        locations : List of [lat, lon] points
+        style : Leaflet path options of the line
+        properties : Popup properties of the line, if any
+        
+    Returns:
+        The GeoJSON feature
+    """
+    return {
+        "type": "Feature",
+        "geometry": {"type": "LineString", "coordinates": _to_geojson_coords(locations)},
+        "properties": {"style": style, **(properties or {})}
+    }
+
+def _polygon_feature(coords : list, style : dict, properties : dict =None):
+    """
+    Build a GeoJSON Polygon feature.
+    
+    Args:
+        coords : List of [lat, lon] points of the exterior ring
+        style : Leaflet path options of the polygon
+        properties : Popup properties of the polygon, if any
+        
+    Returns:
+        The GeoJSON feature
+    """
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Polygon", "coordinates": [_to_geojson_coords(coords)]},
+        "properties": {"style": style, **(properties or {})}
+    }
+
+class FieldsPopup(MacroElement):
+    """
+    Popup of a GeoJSON layer showing a table of the non-empty properties of the clicked feature.
     
-    # Define a list of colors to use for different tiles
-    tile_colors = ['blue', 'green', 'purple', 'orange', 'darkred', 'darkblue', 'darkgreen', 'cadetblue', 'darkpurple', 'pink']
+    Like folium.GeoJsonPopup, the popup is only built when a feature is clicked, but properties
+    missing from a feature are skipped instead of shown as "undefined".
+    """
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        {{ this._parent.get_name() }}.bindPopup(function (layer) {
+            return (""" + POPUP_TABLE_FUNCTION + """)(layer.feature.properties, {{ this.popup_fields|tojson }});
+        }, {maxWidth: {{ this.max_width }}});
+        {% endmacro %}
+    """)
     
-    # Add cities and their tiles to the map
-    for result in cities_results:
-        lat, lon = result['lat'], result['lon']
-        city_name = result.get('city_name', f"City at ({lat}, {lon})")
+    def __init__(self, popup_fields : tuple, max_width : int =300):
+        """
+        Args:
+            popup_fields : (property, label) pairs of the popup rows
+            max_width : Maximum width of the popup in pixels
+        """
+        super().__init__()
+        self._name = 'FieldsPopup'
+        self.popup_fields = [list(row) for row in popup_fields]
+        self.max_width = max_width
+
+def _add_feature_collection(features : list, group : folium.FeatureGroup, popup_fields : tuple =None):
+    """
+    Add features to a group as a single GeoJSON layer, styled from their properties.
+    
+    Args:
+        features : GeoJSON features built by _line_feature or _polygon_feature
+        group : Feature group to add the layer to
+        popup_fields : (property, label) pairs shown in a popup on click, if any
+    """
+    if not features:
+        return
+    
+    layer = folium.GeoJson(
+        {"type": "FeatureCollection", "features": features},
+        style_function=lambda feature: feature['properties']['style']
+    ).add_to(group)
+    if popup_fields:
+        layer.add_child(FieldsPopup(popup_fields))
+
+class ViewportGeoJson(MacroElement):
+    """
+    GeoJSON layer loaded from a separate file, only displaying the features in the current view.
+    
+    Features are styled from their properties, as built by _line_feature and
+    _polygon_feature, and given a popup of the TILE_POPUP_FIELDS properties.
+    """
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        fetch({{ this.url|tojson }})
+            .then(function (response) { return response.json(); })
+            .then(function (data) {
+                var layer = L.geoJSON(null, {
+                    style: function (feature) { return feature.properties.style; },
+                    onEachFeature: function (feature, featureLayer) {
+                        featureLayer.bindPopup(function () {
+                            return (""" + POPUP_TABLE_FUNCTION + """)(feature.properties, {{ this.popup_fields|tojson }});
+                        }, {maxWidth: 300});
+                    }
+                }).addTo({{ this._parent.get_name() }});
+                var featureBounds = data.features.map(function (feature) {
+                    return L.geoJSON(feature).getBounds();
+                });
+                function showVisibleFeatures() {
+                    var viewBounds = {{ this.map_name }}.getBounds();
+                    layer.clearLayers();
+                    layer.addData(data.features.filter(function (feature, i) {
+                        return viewBounds.intersects(featureBounds[i]);
+                    }));
+                }
+                {{ this.map_name }}.on('moveend', showVisibleFeatures);
+                showVisibleFeatures();
+            });
+        {% endmacro %}
+    """)
+    
+    def __init__(self, url : str, map_name : str):
+        """
+        Args:
+            url : URL of the GeoJSON file, relative to the HTML map file
+            map_name : JavaScript name of the folium map
+        """
+        super().__init__()
+        self._name = 'ViewportGeoJson'
+        self.url = url
+        self.map_name = map_name
+        self.popup_fields = [list(row) for row in TILE_POPUP_FIELDS]
+
+def build_city_features(result : dict, tile_color_for_id : dict):
+    """
+    Build the marker and the GeoJSON features of a city or random point and its tiles.
+    
+    Args:
+        result : Query result of the city or random point
+        tile_color_for_id : Color of each tile, keyed by tile ID or title
         
-        # Use display_name if available (for random points)
-        display_name = result.get('display_name', city_name)
+    Returns:
+        Tuple (is_random_point, marker, tile_features, connection_features, random_connection_features),
+        where marker is a [lat, lon, color, radius, popup] row
+    """
+    # GeoJSON features of the shapes of each group
+    tile_features = []
+    connection_features = []
+    random_connection_features = []
+    
+    lat, lon = result['lat'], result['lon']
+    city_name = result.get('city_name', f"City at ({lat}, {lon})")
+    
+    # Use display_name if available (for random points)
+    display_name = result.get('display_name', city_name)
+    
+    is_mosaic = result.get('is_mosaic', False)
+    is_random_point = result.get('is_neighbor', False) or "Random Point" in display_name
+    
+    # Check if the point is on land or in water
+    is_on_land = result.get('is_on_land', True)  # Default to land if not specified
+    has_tiles = result['count'] > 0
+    marker_color, marker_radius = MARKER_STYLES[(bool(is_random_point), bool(is_on_land), has_tiles)]
+    
+    # Color of the random point connections and tiles, based on land/water status
+    base_color = 'green' if is_on_land else 'blue'
+    
+    # Add a marker for the city or random point
+    popup_text = f"<b>{display_name}</b><br>Coordinates: ({lat}, {lon})"
+    
+    if is_random_point:
+        # Add land/water status to popup
+        land_status = result.get('land_status', 'unknown')
+        popup_text += f"<br>Status: {land_status.capitalize()}"
         
-        is_mosaic = result.get('is_mosaic', False)
-        is_random_point = result.get('is_neighbor', False) or "Random Point" in display_name
+    if has_tiles:
+        popup_text += "<br>Best tile selected"
+    else:
+        popup_text += "<br>No tiles found"
         
-        # Determine which feature group to add to based on whether it's a random point
-        target_group = random_point_group if is_random_point else city_group
-        marker_color = 'red'  # Default color for cities
-        marker_radius = 5     # Default radius for cities
+    marker = [round(lat, COORDINATE_PRECISION), round(lon, COORDINATE_PRECISION),
+              marker_color, marker_radius, popup_text]
+    
+    # If this is a random point, draw a line to the original city
+    if is_random_point and 'original_city_lat' in result and 'original_city_lon' in result:
+        original_lat = result['original_city_lat']
+        original_lon = result['original_city_lon']
+        distance = result.get('distance_from_city', 'unknown')
         
-        if is_random_point:
-            # Check if the point is on land or in water
-            is_on_land = result.get('is_on_land', True)  # Default to land if not specified
+        # Add a line connecting the random point to the original city
+        random_connection_features.append(_line_feature(
+            [[original_lat, original_lon], [lat, lon]],
+            {'color': base_color, 'weight': 2, 'opacity': 0.7, 'dashArray': '5, 5'},
+            properties={'distance_km': distance}
+        ))
+    
+    # City metadata of the tile popups, used when missing from a tile
+    fallback_city_name = result.get('city_name')
+    fallback_city_lat = result.get('city_lat')
+    fallback_city_lon = result.get('city_lon')
+    fallback_is_neighbor = result.get('is_neighbor')
+    
+    # Add polygons for each tile's footprint
+    for i, feature in enumerate(result['features']):
+        try:
+            coords = []
+            footprint_source = None
             
-            if is_on_land:
-                marker_color = 'green'  # Green for random points on land
-            else:
-                marker_color = 'blue'   # Blue for random points in water
+            # First try to get the footprint from the feature properties
+            footprint = feature.get('footprint')
+            if footprint and isinstance(footprint, str) and footprint.startswith("POLYGON"):
+                # Parse the footprint WKT string
+                coords = parse_wkt_polygon(footprint)
                 
-            marker_radius = 4  # Smaller radius for random points
+                if len(coords) >= 3:
+                    footprint_source = "WKT String"
             
-            # For random points with no data, use a lighter shade
-            if result['count'] == 0:
-                if is_on_land:
-                    marker_color = 'lightgreen'
-                else:
-                    marker_color = 'lightblue'
-                marker_radius = 3
-        
-        # Add a marker for the city or random point
-        popup_text = f"<b>{display_name}</b><br>Coordinates: ({lat}, {lon})"
-        
-        if is_random_point:
-            # Add land/water status to popup
-            land_status = result.get('land_status', 'unknown')
-            popup_text += f"<br>Status: {land_status.capitalize()}"
-            
-        if result['count'] > 0:
-            popup_text += "<br>Best tile selected"
-        else:
-            popup_text += "<br>No tiles found"
+            # If no valid footprint, try to get geometry from the original feature
+            if len(coords) < 3:
+                # Try to extract geometry from the original_feature
+                original_feature = feature.get('original_feature', {})
+                
+                # Check for restoGeometry (OpenSearch format)
+                if 'restoGeometry' in original_feature:
+                    geom = original_feature['restoGeometry']
+                    if 'type' in geom and geom['type'] == 'Polygon' and 'coordinates' in geom:
+                        # Get coordinates from the geometry
+                        geometry_coords = geom['coordinates'][0]
+                        coords = [[coord[1], coord[0]] for coord in geometry_coords]  # Swap lon/lat to lat/lon for folium
+                        if len(coords) >= 3:
+                            footprint_source = "restoGeometry"
+                
+                # Try standard geometry (STAC format)
+                if len(coords) < 3 and 'geometry' in original_feature:
+                    geom = original_feature['geometry']
+                    if geom and isinstance(geom, dict) and geom.get('type') == 'Polygon' and 'coordinates' in geom:
+                        geometry_coords = geom['coordinates'][0]
+                        coords = [[coord[1], coord[0]] for coord in geometry_coords]  # Swap lon/lat to lat/lon for folium
+                        if len(coords) >= 3:
+                            footprint_source = "GeoJSON geometry"
+                
+                # Try GeoFootprint (OData format)
+                if len(coords) < 3 and 'GeoFootprint' in original_feature:
+                    geom = original_feature['GeoFootprint']
+                    if geom and isinstance(geom, dict) and geom.get('type') == 'Polygon' and 'coordinates' in geom:
+                        geometry_coords = geom['coordinates'][0]
+                        coords = [[coord[1], coord[0]] for coord in geometry_coords]  # Swap lon/lat to lat/lon for folium
+                        if len(coords) >= 3:
+                            footprint_source = "GeoFootprint"
             
-        folium.CircleMarker(
-            location=[lat, lon],
-            radius=marker_radius,
-            color=marker_color,
-            fill=True,
-            fill_color=marker_color,
-            fill_opacity=0.7,
-            popup=popup_text
-        ).add_to(target_group)
-        
-        # If this is a random point, draw a line to the original city
-        if is_random_point and 'original_city_lat' in result and 'original_city_lon' in result:
-            original_lat = result['original_city_lat']
-            original_lon = result['original_city_lon']
-            distance = result.get('distance_from_city', 'unknown')
+            # If still no valid coordinates, create a fallback silently
+            if len(coords) < 3:
+                # Try to create a simple square around the point as fallback
+                if has_tiles:
+                    # Create a simple square around the point (approximately 20km)
+                    box_size = 0.2  # degrees, roughly 20km
+                    # Center the box on the point
+                    box_coords = [
+                        [lat - box_size, lon - box_size],
+                        [lat - box_size, lon + box_size],
+                        [lat + box_size, lon + box_size],
+                        [lat + box_size, lon - box_size],
+                        [lat - box_size, lon - box_size],
+                    ]
+                    coords = box_coords
+                    footprint_source = "fallback square"
+                else:
+                    continue
             
-            # Choose line color based on land/water status
-            is_on_land = result.get('is_on_land', True)
-            line_color = 'green' if is_on_land else 'blue'
+            # Store the footprint source for logging.ing (without warnings)
+            feature['footprint_source'] = footprint_source
             
-            # Add a line connecting the random point to the original city
-            folium.PolyLine(
-                locations=[[original_lat, original_lon], [lat, lon]],
-                color=line_color,
-                weight=2,
-                opacity=0.7,
-                popup=f"Distance: {distance} km",
-                dash_array='5, 5'
-            ).add_to(random_connection_group)
-        
-        # Add polygons for each tile's footprint
-        for i, feature in enumerate(result['features']):
+            # Check if the point is within the polygon
+            point_in_polygon = False
             try:
-                coords = []
-                footprint_source = None
-                
-                # First try to get the footprint from the feature properties
-                footprint = feature.get('footprint')
-                if footprint and isinstance(footprint, str) and footprint.startswith("POLYGON"):
-                    # Parse the footprint WKT string
-                    # Example: "POLYGON((lon1 lat1, lon2 lat2, ...))"
-                    footprint = footprint.replace('POLYGON((', '').replace('))', '')
-                    coords_str = footprint.split(',')
-                    
-                    for coord_str in coords_str:
-                        try:
-                            parts = coord_str.strip().split(' ')
-                            if len(parts) >= 2:
-                                lon_str, lat_str = parts[0], parts[1]
-                                coords.append([float(lat_str), float(lon_str)])
-                        except (ValueError, IndexError) as e:
-                            # Silently continue when a coordinate can't be parsed
-                            pass
-                    
-                    if len(coords) >= 3:
-                        footprint_source = "WKT String"
-                
-                # If no valid footprint, try to get geometry from the original feature
-                if len(coords) < 3:
-                    # Try to extract geometry from the original_feature
-                    original_feature = feature.get('original_feature', {})
-                    
-                    # Check for restoGeometry (OpenSearch format)
-                    if 'restoGeometry' in original_feature:
-                        geom = original_feature['restoGeometry']
-                        if 'type' in geom and geom['type'] == 'Polygon' and 'coordinates' in geom:
-                            # Get coordinates from the geometry
-                            geometry_coords = geom['coordinates'][0]
-                            coords = [[coord[1], coord[0]] for coord in geometry_coords]  # Swap lon/lat to lat/lon for folium
-                            if len(coords) >= 3:
-                                footprint_source = "restoGeometry"
-                    
-                    # Try standard geometry (STAC format)
-                    if len(coords) < 3 and 'geometry' in original_feature:
-                        geom = original_feature['geometry']
-                        if geom and isinstance(geom, dict) and geom.get('type') == 'Polygon' and 'coordinates' in geom:
-                            geometry_coords = geom['coordinates'][0]
-                            coords = [[coord[1], coord[0]] for coord in geometry_coords]  # Swap lon/lat to lat/lon for folium
-                            if len(coords) >= 3:
-                                footprint_source = "GeoJSON geometry"
-                    
-                    # Try GeoFootprint (OData format)
-                    if len(coords) < 3 and 'GeoFootprint' in original_feature:
-                        geom = original_feature['GeoFootprint']
-                        if geom and isinstance(geom, dict) and geom.get('type') == 'Polygon' and 'coordinates' in geom:
-                            geometry_coords = geom['coordinates'][0]
-                            coords = [[coord[1], coord[0]] for coord in geometry_coords]  # Swap lon/lat to lat/lon for folium
-                            if len(coords) >= 3:
-                                footprint_source = "GeoFootprint"
-                
-                # If still no valid coordinates, create a fallback silently
-                if len(coords) < 3:
-                    # Try to create a simple square around the point as fallback
-                    if result['count'] > 0:
-                        # Create a simple square around the point (approximately 20km)
-                        box_size = 0.2  # degrees, roughly 20km
-                        # Center the box on the point
-                        box_coords = [
-                            [lat - box_size, lon - box_size],
-                            [lat - box_size, lon + box_size],
-                            [lat + box_size, lon + box_size],
-                            [lat + box_size, lon - box_size],
-                            [lat - box_size, lon - box_size],
-                        ]
-                        coords = box_coords
-                        footprint_source = "fallback square"
-                    else:
-                        continue
+                # Convert the coordinates to lon/lat for checking
+                poly_coords = [(c[1], c[0]) for c in coords]  # Convert to lon/lat
+                point = (lon, lat)  # Query point
                 
-                # Store the footprint source for logging.ing (without warnings)
-                feature['footprint_source'] = footprint_source
+                # Create a polygon and check if the point is inside
+                polygon = Polygon(poly_coords)
+                point_in_polygon = polygon.contains(Point(point))
                 
-                # Check if the point is within the polygon
-                point_in_polygon = False
-                try:
-                    # Convert the coordinates to lon/lat for checking
-                    poly_coords = [(c[1], c[0]) for c in coords]  # Convert to lon/lat
-                    point = (lon, lat)  # Query point
+                if not point_in_polygon and is_random_point:
+                    # Store the information instead of printing a warning
+                    feature['point_within_footprint'] = False
                     
-                    # Create a polygon and check if the point is inside
-                    polygon = Polygon(poly_coords)
-                    point_in_polygon = polygon.contains(Point(point))
+                    # Calculate the distance from the point to the polygon
+                    from shapely.ops import nearest_points
+                    point_shape = Point(point)
+                    nearest_point = nearest_points(point_shape, polygon)[1]
                     
-                    if not point_in_polygon and is_random_point:
-                        # Store the information instead of printing a warning
-                        feature['point_within_footprint'] = False
-                        
-                        # Calculate the distance from the point to the polygon
+                    # Calculate haversine distance in kilometers
+                    distance_to_tile = haversine_distance(
+                        (point[1], point[0]),  # Convert lon/lat to lat/lon
+                        (nearest_point.y, nearest_point.x)  # Convert lon/lat to lat/lon
+                    )
+                    # Store the distance instead of printing it
+                    feature['distance_to_footprint'] = distance_to_tile
+            except Exception as e:
+                logging.error(f"Error checking if point is in polygon: {e}")
+            
+            # Choose a color and style based on the index and whether it's a random point
+            if is_random_point:
+                # Use a different style if the point is not within the polygon
+                if not point_in_polygon:
+                    color = f"dark{base_color}"
+                    dash_array = '5, 5'
+                    fill_opacity = 0.3
+                    # Add a line connecting the random point to the nearest point on the polygon
+                    try:
                         from shapely.ops import nearest_points
                         point_shape = Point(point)
                         nearest_point = nearest_points(point_shape, polygon)[1]
                         
-                        # Calculate haversine distance in kilometers
-                        distance_to_tile = haversine_distance(
-                            (point[1], point[0]),  # Convert lon/lat to lat/lon
-                            (nearest_point.y, nearest_point.x)  # Convert lon/lat to lat/lon
-                        )
-                        # Store the distance instead of printing it
-                        feature['distance_to_footprint'] = distance_to_tile
-                except Exception as e:
-                    logging.error(f"Error checking if point is in polygon: {e}")
-                
-                # Choose a color and style based on the index and whether it's a random point
-                if is_random_point:
-                    # Choose color based on land/water status
-                    is_on_land = result.get('is_on_land', True)
-                    base_color = 'green' if is_on_land else 'blue'
-                    
-                    # Use a different style if the point is not within the polygon
-                    if not point_in_polygon:
-                        color = f"dark{base_color}"
-                        dash_array = '5, 5'
-                        fill_opacity = 0.3
-                        # Add a line connecting the random point to the nearest point on the polygon
-                        try:
-                            from shapely.ops import nearest_points
-                            point_shape = Point(point)
-                            nearest_point = nearest_points(point_shape, polygon)[1]
-                            
-                            # Add a line to the nearest point on the polygon boundary
-                            folium.PolyLine(
-                                locations=[[lat, lon], [nearest_point.y, nearest_point.x]],
-                                color='red',
-                                weight=2,
-                                opacity=0.7,
-                                popup='Distance to tile boundary',
-                                dash_array='3, 3'
-                            ).add_to(tile_group)
-                        except Exception as e:
-                            logging.error(f"Error creating distance line: {e}")
-                    else:
-                        color = base_color
-                        dash_array = 'none'
-                        fill_opacity = 0.5
+                        # Add a line to the nearest point on the polygon boundary
+                        tile_features.append(_line_feature(
+                            [[lat, lon], [nearest_point.y, nearest_point.x]],
+                            {'color': 'red', 'weight': 2, 'opacity': 0.7, 'dashArray': '3, 3'},
+                            properties={'title': 'Distance to tile boundary',
+                                        'distance_km': round(feature.get('distance_to_footprint', 0), 2)}
+                        ))
+                    except Exception as e:
+                        logging.error(f"Error creating distance line: {e}")
                 else:
-                    color = tile_colors[i % len(tile_colors)]
-                    dash_array = 'none' if i == 0 else '5, 5'
+                    color = base_color
+                    dash_array = 'none'
                     fill_opacity = 0.5
-                    
-                # Create a popup with information about the tile
-                popup_html = f"""
-                <b>Tile Information:</b><br>
-                <b>Title:</b> {feature['title']}<br>
-                """
-                
-                # Add warning if the random point is not within the tile footprint
-                if not feature.get('point_within_footprint', True) and is_random_point:
-                    popup_html += f"<b>Note:</b> Point is outside tile boundary ({feature.get('distance_to_footprint', 0):.2f} km away)<br>"
-                
-                if 'start_date' in feature:
-                    popup_html += f"<b>Start Date:</b> {feature['start_date']}<br>"
-                
-                popup_html += f"<b>Product Type:</b> {feature['product_type']}<br>"
-                
-                if feature.get('tile_id'):
-                    popup_html += f"<b>Tile ID:</b> {feature['tile_id']}<br>"
-                
-                if feature.get('quarterly_count'):
-                    popup_html += f"<b>Quarterly Products:</b> {feature['quarterly_count']}<br>"
-                
-                if feature.get('quarters'):
-                    popup_html += f"<b>Quarters:</b> {', '.join(feature.get('quarters', []))}<br>"
-                
-                # Add the city metadata to the popup
-                # First try to get from feature, then from result if not available
-                city_name = feature.get('city_name') or result.get('city_name')
-                city_lat = feature.get('city_lat') or result.get('city_lat')
-                city_lon = feature.get('city_lon') or result.get('city_lon')
-                is_neighbor = feature.get('is_neighbor')
-                if is_neighbor is None and 'is_neighbor' in result:
-                    is_neighbor = result.get('is_neighbor')
-                
-                if city_name:
-                    popup_html += f"<b>Associated City:</b> {city_name}<br>"
-                
-                if city_lat is not None and city_lon is not None:
-                    popup_html += f"<b>City Coordinates:</b> ({city_lat:.4f}, {city_lon:.4f})<br>"
-                
-                if is_neighbor is not None:
-                    neighbor_status = "Random Point" if is_neighbor else "City Center"
-                    popup_html += f"<b>Point Type:</b> {neighbor_status}<br>"
-                
-                if feature.get('download_url'):
-                    popup_html += f"<a href='{feature['download_url']}' target='_blank'>Download Link</a>"
-                
-                # Add the polygon to the map
-                folium.Polygon(
-                    locations=coords,
-                    color=color,
-                    weight=2,
-                    dash_array=dash_array,
-                    fill=True,
-                    fill_color=color,
-                    fill_opacity=fill_opacity,
-                    popup=folium.Popup(popup_html, max_width=300)
-                ).add_to(tile_group)
-                
-                # Add a line connecting the city to the center of the tile
-                # Calculate the center of the polygon
-                center_lat = sum(lat for lat, _ in coords) / len(coords)
-                center_lon = sum(lon for _, lon in coords) / len(coords)
+            else:
+                color = tile_color_for_id[feature.get('tile_id') or feature.get('title', '')]
+                dash_array = 'none' if i == 0 else '5, 5'
+                fill_opacity = 0.5
                 
-                # Add a line connecting the city to the tile center
-                folium.PolyLine(
-                    locations=[[lat, lon], [center_lat, center_lon]],
-                    color=color,
-                    weight=1,
-                    opacity=0.5,
-                    dash_array='3, 5'
-                ).add_to(connection_group)
-            except (KeyError, ValueError, TypeError, Exception) as e:
-                logging.error(f"Error processing tile {feature.get('title', 'Unknown')}: {e}")
+            # Store the popup information about the tile, shown by Leaflet when the tile is clicked
+            popup_properties = {
+                'title': feature['title'],
+                'start_date': feature.get('start_date'),
+                'product_type': feature['product_type'],
+                'tile_id': feature.get('tile_id'),
+                'quarterly_count': feature.get('quarterly_count'),
+                'quarters': ', '.join(feature.get('quarters') or []),
+            }
+            
+            # Add the distance if the random point is not within the tile footprint
+            if not feature.get('point_within_footprint', True) and is_random_point:
+                popup_properties['distance_km'] = round(feature.get('distance_to_footprint', 0), 2)
+            
+            # Add the city metadata to the popup
+            # First try to get from feature, then from result if not available
+            city_name = feature.get('city_name') or fallback_city_name
+            city_lat = feature.get('city_lat') or fallback_city_lat
+            city_lon = feature.get('city_lon') or fallback_city_lon
+            is_neighbor = feature.get('is_neighbor')
+            if is_neighbor is None:
+                is_neighbor = fallback_is_neighbor
+            
+            popup_properties['city_name'] = city_name
+            
+            if city_lat is not None and city_lon is not None:
+                popup_properties['city_coordinates'] = f"({city_lat:.4f}, {city_lon:.4f})"
+            
+            if is_neighbor is not None:
+                popup_properties['point_type'] = "Random Point" if is_neighbor else "City Center"
+            
+            if feature.get('download_url'):
+                popup_properties['download'] = f"<a href='{feature['download_url']}' target='_blank'>Download Link</a>"
+            
+            # Add the polygon to the map
+            tile_features.append(_polygon_feature(
+                simplify_footprint(coords),
+                {'color': color, 'weight': 2, 'dashArray': dash_array, 'fill': True,
+                 'fillColor': color, 'fillOpacity': fill_opacity},
+                properties=popup_properties
+            ))
+            
+            # Add a line connecting the city to the center of the tile
+            # Calculate the center of the polygon
+            center_lat, center_lon = np.asarray(coords, dtype=np.float64).mean(axis=0).tolist()
+            
+            # Add a line connecting the city to the tile center
+            connection_features.append(_line_feature(
+                [[lat, lon], [center_lat, center_lon]],
+                {'color': color, 'weight': 1, 'opacity': 0.5, 'dashArray': '3, 5'}
+            ))
+        except (KeyError, ValueError, TypeError, Exception) as e:
+            logging.error(f"Error processing tile {feature.get('title', 'Unknown')}: {e}")
     
-    # Add layer control
-    folium.LayerControl().add_to(m)
+    return is_random_point, marker, tile_features, connection_features, random_connection_features
+
+def create_mosaic_map(cities_results : list, output_file : str ='maps/city_mosaics_map.html', dynamic_load : bool =False):
+    """
+    Create an interactive map showing cities and their associated Sentinel-2 mosaic tiles.
+    
+    Args:
+        cities_results : List of dictionaries containing query results for each city
+        output_file : Path to save the HTML map file
+        dynamic_load : If True, save the tile footprints to a GeoJSON file next to the map and
+            only display the ones in the current view. The map must then be served over HTTP,
+            since browsers block loading local files from a page opened from disk
+        
+    Returns:
+        Path to the saved HTML map file
+    """
+    logging.info(f"Creating interactive map with {len(cities_results)} cities and their Sentinel-2 tiles")
+    
+    # Create a map centered at the average of all coordinates
+    valid_coords = np.array([(r['lat'], r['lon']) for r in cities_results if r['count'] > 0], dtype=np.float64)
+    
+    if valid_coords.size == 0:
+        logging.warning("No valid coordinates with Sentinel-2 data found")
+        return None
+    
+    avg_lat, avg_lon = valid_coords.mean(axis=0).tolist()
+    
+    # Create a map with the default CartoDB positron tiles
+    m = folium.Map(location=[avg_lat, avg_lon], zoom_start=3, tiles=None)
+    
+    # Add the base maps, minimap and measurement tools
+    _add_base_layers(m)
+    
+    # Create feature groups for better organization
+    city_group = folium.FeatureGroup(name="Cities")
+    random_point_group = folium.FeatureGroup(name="Random Points")
+    tile_group = folium.FeatureGroup(name="Sentinel-2 Tiles")
+    connection_group = folium.FeatureGroup(name="City-Tile Connections")
+    random_connection_group = folium.FeatureGroup(name="City-Random Point Connections")
+    
+    m.add_child(city_group)
+    m.add_child(random_point_group)
+    m.add_child(tile_group)
+    m.add_child(connection_group)
+    m.add_child(random_connection_group)
+    
+    # Markers of the cities and random points, as [lat, lon, color, radius, popup] rows
+    city_markers = []
+    random_point_markers = []
+    
+    # GeoJSON features of the shapes added to each group
+    tile_features = []
+    connection_features = []
+    random_connection_features = []
+    
+    # Assign each tile a color from a hash of its ID, so a tile keeps its color across cities and map regenerations
+    # (zlib.crc32 is used since the built-in hash of strings changes between runs)
+    tile_keys = {feature.get('tile_id') or feature.get('title', '')
+                 for result in cities_results for feature in result['features']}
+    tile_color_for_id = {key: TILE_COLORS[zlib.crc32(key.encode('utf-8')) % len(TILE_COLORS)] for key in tile_keys}
+    
+    # Build the cities' markers and tiles, then add them to the map in order
+    for result in cities_results:
+        is_random_point, marker, city_tiles, city_connections, city_random_connections = build_city_features(result, tile_color_for_id)
+        (random_point_markers if is_random_point else city_markers).append(marker)
+        tile_features.extend(city_tiles)
+        connection_features.extend(city_connections)
+        random_connection_features.extend(city_random_connections)
+    
+    # Add the markers as clusters, built client-side from their coordinates
+    if city_markers:
+        FastMarkerCluster(city_markers, callback=CIRCLE_MARKER_CALLBACK).add_to(city_group)
+    if random_point_markers:
+        FastMarkerCluster(random_point_markers, callback=CIRCLE_MARKER_CALLBACK).add_to(random_point_group)
     
     # Create directory if it doesn't exist
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
     
+    # Add each group's shapes as a single GeoJSON layer
+    if dynamic_load:
+        # Save the tiles to a separate file loaded by the map
+        tiles_file = f"{os.path.splitext(output_file)[0]}_tiles.geojson"
+        with open(tiles_file, 'wb') as f:
+            f.write(orjson.dumps({"type": "FeatureCollection", "features": tile_features}))
+        ViewportGeoJson(os.path.basename(tiles_file), m.get_name()).add_to(tile_group)
+        logging.info(f"Tile footprints saved to {tiles_file}")
+    else:
+        _add_feature_collection(tile_features, tile_group, popup_fields=TILE_POPUP_FIELDS)
+    _add_feature_collection(connection_features, connection_group)
+    _add_feature_collection(random_connection_features, random_connection_group, popup_fields=RANDOM_CONNECTION_POPUP_FIELDS)
+    
+    # Add layer control
+    folium.LayerControl().add_to(m)
+    
     # Save the map
-    m.save(output_file)
-    logging.info(f"Interactive map saved to {output_file}")
+    save_map(m, output_file)
+    logging.info(f"Interactive map saved to {output_file} and {output_file}.gz")
     
     return output_file
\ No newline at end of file
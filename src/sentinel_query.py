@@ -5,29 +5,18 @@ This module provides functions for querying Sentinel-2 Global Mosaics data from
 """
 
 import os
-import json
+import orjson
 import logging 
-import requests
-import sys
 from datetime import datetime, timedelta
 import math
-import random
 import numpy as np
-from shapely.geometry import Point 
-from shapely.geometry.polygon import Polygon
-import geopandas as gpd
-import warnings
-from src.token_manager import ensure_valid_token, get_access_token
+import shapely
+from src.token_manager import ensure_valid_token, get_access_token, refresh_rejected_token
+from src.http_session import SESSION
+from src.land_index import are_points_on_land
 
-# Global variable to store the land polygons once loaded
-_LAND_POLYGONS = None
-
-
-# Create data directory path
-project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-data_dir = os.path.join(project_root, 'data')
-os.makedirs(data_dir, exist_ok=True)
-import sys
+# Maximum number of products returned by a query, well above the few tiles per quarter around a point
+MAX_PRODUCTS_PER_QUERY = 1000
 
 def make_sentinel_request(url : str, headers : dict, params : dict, max_retries : int =2):
     """
@@ -43,11 +32,14 @@ def make_sentinel_request(url : str, headers : dict, params : dict, max_retries
         The response from the API
     """
     for retry in range(max_retries + 1):
-        response = requests.get(url, headers=headers, params=params)
+        response = SESSION.get(url, headers=headers, params=params)
         
         if response.status_code in [401, 403] and retry < max_retries:
             logging.info(f"Authentication error ({response.status_code}). Refreshing token...")
-            new_access_token = get_access_token()
+            # The token was rejected, so it is refreshed even if it has not expired yet, unless another request already did
+            rejected_access_token = headers.get('Authorization', '')[len('Bearer '):]
+            new_token_data = refresh_rejected_token(rejected_access_token)
+            new_access_token = new_token_data.get('access_token') if new_token_data else None
             if new_access_token:
                 headers = {'Authorization': f'Bearer {new_access_token}'}
                 continue
@@ -76,11 +68,9 @@ def process_product(product : dict, quarter : str, query_point):
             try:
                 if product['GeoFootprint']['type'] == 'Polygon':
                     coords = product['GeoFootprint']['coordinates'][0]
-                    tile_polygon = Polygon(coords)
-                    # Point takes (x, y) which is (lon, lat)
-                    query_point_obj = Point(query_point[0], query_point[1])
-                    
-                    if tile_polygon.contains(query_point_obj):
+                    tile_polygon = shapely.polygons(coords)
+                    # Test the (x, y) which is (lon, lat) coordinates directly, without creating a Point
+                    if shapely.contains_xy(tile_polygon, query_point[0], query_point[1]):
                         product_entry["contains_query_point"] = True
                         return product_entry, True
             except Exception as e:
@@ -92,6 +82,43 @@ def process_product(product : dict, quarter : str, query_point):
         logging.error(f"Unexpected error while processing product: {e}")
         return None, False
 
+def parse_tile_id(name : str):
+    """
+    Extract the tile ID from a product name, its fifth underscore-separated field.
+    
+    Args:
+        name : The product name
+        
+    Returns:
+        The tile ID, or None if the name has less than five fields
+    """
+    # Find the fourth underscore without splitting the whole name
+    start = -1
+    for _ in range(4):
+        start = name.find('_', start + 1)
+        if start < 0:
+            return None
+    end = name.find('_', start + 1)
+    return name[start + 1:] if end < 0 else name[start + 1:end]
+
+def first_tile_id(products : list):
+    """
+    Get the tile ID of the first product with a parsable name.
+    
+    Args:
+        products : List of products
+        
+    Returns:
+        The tile ID, or None if no product name contains one
+    """
+    for product in products:
+        name = product.get('Name')
+        if name:
+            tile_id = parse_tile_id(name)
+            if tile_id is not None:
+                return tile_id
+    return None
+
 def select_best_products(products_containing_point : list, quarterly_products : list):
     """
     Select the best products based on tile ID and query point containment.
@@ -104,19 +131,13 @@ def select_best_products(products_containing_point : list, quarterly_products :
         list: The selected products
     """
     if products_containing_point:
-        logging.info(f"Found {len(products_containing_point)} products that contain the query point.")
-        best_tile_id = None
-        for product in products_containing_point:
-            if 'Name' in product:
-                parts = product['Name'].split('_')
-                if len(parts) >= 5:
-                    best_tile_id = parts[4]
-                    break
+        logging.debug(f"Found {len(products_containing_point)} products that contain the query point.")
+        best_tile_id = first_tile_id(products_containing_point)
         
         if best_tile_id:
             final_products = [p for p in products_containing_point 
                             if 'Name' in p and best_tile_id in p['Name']]
-            logging.info(f"Selected {len(final_products)} products from the best tile {best_tile_id}")
+            logging.debug(f"Selected {len(final_products)} products from the best tile {best_tile_id}")
         else:
             final_products = products_containing_point
     else:
@@ -125,13 +146,12 @@ def select_best_products(products_containing_point : list, quarterly_products :
             # Get the tile ID from the first product
             first_product = quarterly_products[0]
             if 'Name' in first_product:
-                parts = first_product['Name'].split('_')
-                if len(parts) >= 5:
-                    best_tile_id = parts[4]  # Extract the tile ID part
+                best_tile_id = parse_tile_id(first_product['Name'])
+                if best_tile_id is not None:
                     # Filter to only keep products from this tile
                     final_products = [p for p in quarterly_products 
                                     if 'Name' in p and best_tile_id in p['Name']]
-                    logging.info(f"Selected {len(final_products)} products from the closest tile {best_tile_id}")
+                    logging.debug(f"Selected {len(final_products)} products from the closest tile {best_tile_id}")
                 else:
                     final_products = quarterly_products
         else:
@@ -164,9 +184,12 @@ def query_sentinel2_by_coordinates(lat : float, lon : float, year : str ="2023",
         return None
         
     headers = {'Authorization': f'Bearer {access_token}'}
+    # Queries of concurrent cities are logged together, so the messages of a query are tagged with its point
+    query_label = f"{city_name} ({lat}, {lon})"
     quarters = ["Q1", "Q2", "Q3", "Q4"]
     box_size = 0.1
-    os.makedirs(output_dir, exist_ok=True)
+    if save_results:
+        os.makedirs(output_dir, exist_ok=True)
     
     products_containing_point = []
     quarterly_products = []
@@ -181,21 +204,26 @@ def query_sentinel2_by_coordinates(lat : float, lon : float, year : str ="2023",
         c = 2 * math.asin(math.sqrt(a))
         distance_km = c * 6371  # Radius of Earth in kilometers
     
-    # Query each quarter
+    url = "https://catalogue.dataspace.copernicus.eu/odata/v1/Products"
+    spatial_filter = f"OData.CSC.Intersects(area=geography'SRID=4326;POLYGON(({lon-box_size} {lat-box_size}, {lon-box_size} {lat+box_size}, {lon+box_size} {lat+box_size}, {lon+box_size} {lat-box_size}, {lon-box_size} {lat-box_size}))')"
+    
+    # Query all quarters in a single request, the products are split by quarter afterwards
+    quarter_filter = " or ".join(f"contains(Name,'{year}_{quarter}')" for quarter in quarters)
+    params = {
+        "$filter": f"({spatial_filter}) and Collection/Name eq 'GLOBAL-MOSAICS' and ({quarter_filter})",
+        "$top": MAX_PRODUCTS_PER_QUERY
+    }
+    response = make_sentinel_request(url, headers, params)
+    logging.debug(f"{query_label} status code: {response.status_code}")
+    products_by_quarter = handle_api_error(response, year, quarters, query_label)
+    if products_by_quarter is None:
+        return None
+    
+    # Process each quarter
     for quarter in quarters:
-        url = "https://catalogue.dataspace.copernicus.eu/odata/v1/Products"
-        spatial_filter = f"OData.CSC.Intersects(area=geography'SRID=4326;POLYGON(({lon-box_size} {lat-box_size}, {lon-box_size} {lat+box_size}, {lon+box_size} {lat+box_size}, {lon+box_size} {lat-box_size}, {lon-box_size} {lat-box_size}))')"
-        params = {
-            "$filter": f"({spatial_filter}) and Collection/Name eq 'GLOBAL-MOSAICS' and contains(Name,'{year}_{quarter}')"
-        }
-
-        response = make_sentinel_request(url, headers, params)
-        print(f"\n")
-        logging.info(f"{year} {quarter}:")
-        logging.info(f"Status code: {response.status_code}")
+        logging.debug(f"{query_label} {year} {quarter}: {len(products_by_quarter[quarter])} products")
         
-        result = handle_api_error(response, year, quarter)
-        for product in result.get('value', []):
+        for product in products_by_quarter[quarter]:
             product_entry, contains_point = process_product(product, quarter, (lon, lat))
             if contains_point:
                 products_containing_point.append(product_entry)
@@ -211,14 +239,13 @@ def query_sentinel2_by_coordinates(lat : float, lon : float, year : str ="2023",
     if len(final_products) != 4:
         found_quarters = set(p.get('quarter') for p in final_products)
         missing_quarters = set(quarters) - found_quarters
-        logging.warning(f"Warning: Found {len(final_products)} products instead of expected 4.")
-        logging.warning(f"Missing quarters: {missing_quarters}")
-        logging.warning(f"Found quarters: {found_quarters}")
+        logging.warning(f"{query_label}: found {len(final_products)} products instead of expected 4. "
+                        f"Missing quarters: {missing_quarters}, found quarters: {found_quarters}")
         return None
     
     # Sort products by quarter
     final_products.sort(key=lambda x: x.get('quarter'))
-    logging.info(f"\nSelected {len(final_products)} out of {len(quarterly_products)} quarterly products")
+    logging.debug(f"{query_label}: selected {len(final_products)} out of {len(quarterly_products)} quarterly products")
     
     # Create the result structure
     area = {
@@ -248,68 +275,41 @@ def query_sentinel2_by_coordinates(lat : float, lon : float, year : str ="2023",
     
     return result
 
-def handle_api_error(response, year : str, quarter : str):
+def handle_api_error(response, year : str, quarters : list, query_label : str =""):
     """
-    Handle API errors and stop execution if necessary.
+    Handle API errors and split the products by quarter.
     
     Args:
         response : The API response object.
         year : The year of the query.
-        quarter : The quarter of the query.
+        quarters : The quarters of the query.
+        query_label : Label of the query point, prepended to the error messages.
+        
+    Returns:
+        Dictionary of the products of each quarter, or None if the request failed or a quarter has no product
     """
     try:
         response.raise_for_status()
     except Exception as e:
-        logging.error(f"HTTP error: {e}")
-        sys.exit(1)
-
-    result = response.json()
-    if not result.get('value', []):
-        logging.error(f"Error: No products found for {year} {quarter}. Stopping execution.\033[0m")
-        sys.exit(1)
-    return result
+        logging.error(f"{query_label} HTTP error: {e}")
+        return None
 
-def is_point_on_land(lat : float, lon : float, debug : bool=False):
-    """
-    Check if a geographic point is on land or in water.
+    result = orjson.loads(response.content)
+    products_by_quarter = {quarter: [] for quarter in quarters}
+    for product in result.get('value', []):
+        name = product.get('Name', '')
+        for quarter in quarters:
+            if f"{year}_{quarter}" in name:
+                products_by_quarter[quarter].append(product)
+                break
     
-    Args:
-        lat : Latitude of the point
-        lon : Longitude of the point
-        debug : Whether to print debug information
-        
-    Returns:
-        True if the point is on land, False if it's in water
-    """
-    global _LAND_POLYGONS
-    
-    point = Point(lon, lat)
-    
-    if _LAND_POLYGONS is None:
-        try:
-            ne_file = os.path.join(data_dir, 'ne_110m_land.shp')
-            if os.path.exists(ne_file):
-                logging.info(f"Loading land polygons from {ne_file}")
-                _LAND_POLYGONS = gpd.read_file(ne_file)
-            else:
-                warnings.warn("Land polygon file not found. Cannot determine if point is on land.")
-                return False
-        except ImportError:
-            warnings.warn("Geopandas not installed. Cannot determine if point is on land.")
-            return False
-        except FileNotFoundError:
-            warnings.warn("Land polygon file not found. Cannot determine if point is on land.")
-            return False
-        except ValueError:
-            warnings.warn("Error parsing land polygon file. Cannot determine if point is on land.")
-            return False
-        except Exception as e:
-            warnings.warn(f"Error loading land polygons: {e}. Cannot determine if point is on land.")
-            return False
-    
-    return any(point.within(row.geometry) for _, row in _LAND_POLYGONS.iterrows())
+    for quarter in quarters:
+        if not products_by_quarter[quarter]:
+            logging.error(f"{query_label} error: No products found for {year} {quarter}. Skipping this point.")
+            return None
+    return products_by_quarter
 
-def get_random_point_at_distance(lat : float, lon : float, distance_km : float, ensure_on_land : bool =True, max_attempts : int =10, debug : bool =False):
+def get_random_point_at_distance(lat : float, lon : float, distance_km : float, ensure_on_land : bool =True, max_attempts : int =10, rng : np.random.Generator =None):
     """
     Generate a random point at a specified distance from a given location.
     Optionally ensure the point is on land.
@@ -320,49 +320,57 @@ def get_random_point_at_distance(lat : float, lon : float, distance_km : float,
         distance_km : Distance in kilometers
         ensure_on_land : If True, ensure the generated point is on land
         max_attempts : Maximum number of attempts to find a point on land
-        debug : Whether to print debug information
+        rng : Random number generator to draw the bearings from, defaults to a new one
         
     Returns:
         (latitude, longitude, is_on_land) of the random point, or None if ensure_on_land is True
                 and no land point could be found after max_attempts
     """
+    # Draw all the attempts at once and test them against the land in a single query
+    new_lats, new_lons = get_random_points_at_distance(lat, lon, distance_km, max_attempts if ensure_on_land else 1, rng)
+    on_land = are_points_on_land(new_lats, new_lons)
     if not ensure_on_land:
-        new_lat, new_lon = _generate_random_point_at_distance(lat, lon, distance_km)
-        return new_lat, new_lon, is_point_on_land(new_lat, new_lon, debug)
+        return float(new_lats[0]), float(new_lons[0]), bool(on_land[0])
     
-    for _ in range(max_attempts):
-        new_lat, new_lon = _generate_random_point_at_distance(lat, lon, distance_km)
-        if is_point_on_land(new_lat, new_lon, debug):
-            return new_lat, new_lon, True
+    # Keep the first point on land
+    idx = int(np.argmax(on_land))
+    if on_land[idx]:
+        return float(new_lats[idx]), float(new_lons[idx]), True
     
     return None
 
-def _generate_random_point_at_distance(lat : float, lon : float, distance_km : float):
+def get_random_points_at_distance(lat : float, lon : float, distance_km : float, num_points : int, rng : np.random.Generator =None):
     """
-    Generate a random point at a specified distance from a given location.
+    Generate random points at a specified distance from a given location, all at once.
     
     Args:
         lat : Latitude of the center point
         lon : Longitude of the center point
         distance_km : Distance in kilometers
+        num_points : Number of points to generate
+        rng : Random number generator to draw the bearings from, defaults to a new one
         
     Returns:
-        (latitude, longitude) of the random point
+        (latitudes, longitudes) arrays of the random points
     """
+    if rng is None:
+        rng = np.random.default_rng()
+    
     R = 6371.0  # Earth's radius in kilometers
     distance_rad = distance_km / R
     lat_rad = math.radians(lat)
     lon_rad = math.radians(lon)
-    bearing_rad = math.radians(random.uniform(0, 360))
+    bearing_rad = np.radians(rng.uniform(0, 360, num_points))
     
-    new_lat_rad = math.asin(
+    new_lat_rad = np.arcsin(
         math.sin(lat_rad) * math.cos(distance_rad) +
-        math.cos(lat_rad) * math.sin(distance_rad) * math.cos(bearing_rad)
+        math.cos(lat_rad) * math.sin(distance_rad) * np.cos(bearing_rad)
     )
     
-    new_lon_rad = lon_rad + math.atan2(
-        math.sin(bearing_rad) * math.sin(distance_rad) * math.cos(lat_rad),
-        math.cos(distance_rad) - math.sin(lat_rad) * math.sin(new_lat_rad)
+    new_lon_rad = lon_rad + np.arctan2(
+        np.sin(bearing_rad) * math.sin(distance_rad) * math.cos(lat_rad),
+        math.cos(distance_rad) - math.sin(lat_rad) * np.sin(new_lat_rad)
     )
     
-    return math.degrees(new_lat_rad), math.degrees(new_lon_rad)
\ No newline at end of file
+    # Wrap the longitudes back into [-180, 180) for the points across the antimeridian
+    return np.degrees(new_lat_rad), (np.degrees(new_lon_rad) + 540) % 360 - 180
\ No newline at end of file
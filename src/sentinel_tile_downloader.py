@@ -7,7 +7,7 @@ It handles token refresh for the Copernicus Data Space API.
 """
 
 import os
-import json
+import orjson
 import argparse
 import requests
 import logging
@@ -16,7 +16,8 @@ from datetime import datetime
 from pathlib import Path
 import re
 from tqdm import tqdm
-from src.token_manager import ensure_valid_token, get_access_token
+from src.token_manager import ensure_valid_token, get_access_token, refresh_rejected_token
+from src.http_session import SESSION
 
 # Set up logging
 logging.basicConfig(
@@ -25,6 +26,24 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+def _download_url(properties : dict):
+    """
+    Get the download URL from the services of product properties.
+    
+    Args:
+        properties : The product properties, with an optional services dict
+        
+    Returns:
+        The download URL, or None as soon as a level is missing
+    """
+    services = properties.get('services')
+    if not services:
+        return None
+    download = services.get('download')
+    if not download:
+        return None
+    return download.get('url')
+
 class SentinelDownloader:
     """Class to handle Sentinel-2 tile downloads with token management."""
     
@@ -53,8 +72,9 @@ class SentinelDownloader:
     def refresh_access_token(self):
         """Refresh the access token using the refresh token."""
         logging.info("Refreshing access token...")
-        # Always refresh the token using token_manager
-        self.access_token = get_access_token()
+        # Always refresh the token using token_manager, even if the saved one has not expired yet
+        token_data = refresh_rejected_token(self.access_token)
+        self.access_token = token_data.get('access_token') if token_data else None
         if self.access_token:
             logging.info("Access token refreshed successfully")
             return True
@@ -79,13 +99,13 @@ class SentinelDownloader:
             
             # Extract tile ID from title
             tile_id = None
-            parts = title.split('_')
+            parts = title.split('_', 5)
             if len(parts) >= 5:
                 tile_id = parts[4]  # Extract the tile ID part
             
             # Extract product ID for OData API
             product_id = None
-            download_url = props.get('services', {}).get('download', {}).get('url')
+            download_url = _download_url(props)
             if download_url:
                 match = re.search(r'/download/([a-f0-9-]+)', download_url)
                 if match:
@@ -116,7 +136,7 @@ class SentinelDownloader:
             
             # Extract tile ID from title
             tile_id = None
-            parts = title.split('_')
+            parts = title.split('_', 5)
             if len(parts) >= 5:
                 tile_id = parts[4]  # Extract the tile ID part
             
@@ -124,10 +144,8 @@ class SentinelDownloader:
             product_id = feature.get('Id')
             
             # Get download URL from restoProperties.services if available
-            download_url = None
             resto_props = feature.get('restoProperties', {})
-            if 'services' in resto_props and 'download' in resto_props['services']:
-                download_url = resto_props['services']['download'].get('url')
+            download_url = _download_url(resto_props)
             
             # Create a processed feature
             processed_feature = {
@@ -186,7 +204,7 @@ class SentinelDownloader:
             logging.info(f"Sending request to: {self.CATALOGUE_URL}")
             logging.info(f"With parameters: {params}")
             
-            response = requests.get(self.CATALOGUE_URL, params=params)
+            response = SESSION.get(self.CATALOGUE_URL, params=params)
             
             # Log the full URL for debugging
             logging.info(f"Full request URL: {response.url}")
@@ -197,7 +215,7 @@ class SentinelDownloader:
                 return None
             
             # Parse the JSON response
-            json_data = response.json()
+            json_data = orjson.loads(response.content)
             
             # Check if we have features
             if 'features' not in json_data or len(json_data['features']) == 0:
@@ -217,7 +235,7 @@ class SentinelDownloader:
                     logging.info(f"Found matching tile: {title}")
                     
                     # Extract download URL
-                    download_url = props.get('services', {}).get('download', {}).get('url')
+                    download_url = _download_url(props)
                     
                     if not download_url:
                         logging.warning(f"No download URL found for tile: {title}")
@@ -314,7 +332,7 @@ class SentinelDownloader:
         # If we still don't have a year, try to extract it from the title
         if not year and title:
             # Try to find year in title, like "Sentinel-2_mosaic_2023_Q1_54SUE_0_0"
-            parts = title.split('_')
+            parts = title.split('_', 3)
             if len(parts) >= 4:
                 potential_year = parts[2]
                 if potential_year.isdigit() and len(potential_year) == 4:
@@ -322,7 +340,7 @@ class SentinelDownloader:
         
         # Extract tile ID from title if not available
         if not tile_id and title:
-            parts = title.split('_')
+            parts = title.split('_', 5)
             if len(parts) >= 5:
                 tile_id = parts[4]  # Extract the tile ID part (e.g., "54SUE")
         
@@ -378,8 +396,8 @@ class SentinelDownloader:
             properties = feature['properties']
             if not product_id:
                 product_id = properties.get('product_id')
-            if not download_url and 'services' in properties and 'download' in properties['services']:
-                download_url = properties['services']['download'].get('url')
+            if not download_url:
+                download_url = _download_url(properties)
         
         # Extract product ID from the download URL if available
         if not product_id and download_url:
@@ -458,7 +476,7 @@ class SentinelDownloader:
                 
                 # Use a GET request with stream=True to avoid downloading the whole file
                 # but still follow redirects to get the final URL
-                check_response = requests.get(url, headers=headers, stream=True, allow_redirects=True)
+                check_response = SESSION.get(url, headers=headers, stream=True, allow_redirects=True)
                 
                 # Close the connection to avoid downloading the file
                 check_response.close()
@@ -476,7 +494,7 @@ class SentinelDownloader:
             
             # Stream the download to handle large files
             logging.info(f"Starting download from: {url}")
-            with requests.get(url, headers=headers, stream=True, allow_redirects=True) as response:
+            with SESSION.get(url, headers=headers, stream=True, allow_redirects=True) as response:
                 if response.status_code == 401:
                     logging.warning("Unauthorized: Token may be expired or insufficient permissions")
                     # Log response headers for debugging
@@ -571,11 +589,9 @@ class SentinelDownloader:
             json_file : Path to the JSON file containing tile information
             output_dir x: Directory to save downloaded files
         """
-        import json
-        
         # Load the JSON file
-        with open(json_file, 'r') as f:
-            data = json.load(f)
+        with open(json_file, 'rb') as f:
+            data = orjson.loads(f.read())
         
         # Extract features from the JSON
         features = []
@@ -600,7 +616,7 @@ class SentinelDownloader:
                     for product in area['quarterlyProducts']:
                         # Extract the tile ID from the product name (e.g., "Sentinel-2_mosaic_2023_Q1_54SUE_0_0")
                         product_name = product.get('Name', '')
-                        parts = product_name.split('_')
+                        parts = product_name.split('_', 5)
                         
                         # Extract tile ID, year, and quarter from product name
                         tile_id = None
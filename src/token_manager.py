@@ -6,15 +6,25 @@ Copernicus Data Space API.
 """
 
 import os
-import json
+import orjson
 import getpass
 import logging
-import requests
+import threading
+import time
 from requests.exceptions import HTTPError, Timeout, RequestException
+from src.http_session import SESSION
 
 # Global constants
 TOKEN_URL = "https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token"
 DEFAULT_TOKEN_FILE = 'copernicus_dataspace_token.json'
+# Seconds before its expiry from which a saved token is refreshed instead of reused
+TOKEN_EXPIRY_MARGIN = 60
+
+# Lock so that concurrent requests check and refresh the token one at a time
+_TOKEN_LOCK = threading.Lock()
+
+# Last valid token of each token file, reused by the next calls without reading the file
+_CACHED_TOKENS = {}
 
 def get_token_path(token_file=None):
     """Get the path to the token file."""
@@ -22,27 +32,41 @@ def get_token_path(token_file=None):
         return os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), DEFAULT_TOKEN_FILE)
     return token_file
 
+def is_token_valid(token_data):
+    """Check if the access token of the token data is valid for more than the expiry margin."""
+    return token_data is not None and token_data.get('expires_at', 0) - time.time() > TOKEN_EXPIRY_MARGIN
+
 def load_token(token_file=None):
     """Load the token from the token file."""
     token_path = get_token_path(token_file)
     try:
         if os.path.exists(token_path):
-            with open(token_path, 'r') as f:
-                return json.load(f)
+            with open(token_path, 'rb') as f:
+                return orjson.loads(f.read())
     except FileNotFoundError:
         logging.error(f"Token file not found: {token_path}")
     except PermissionError:
         logging.error(f"Permission denied to read token file: {token_path}")
-    except (json.JSONDecodeError, IOError) as e:
+    except (orjson.JSONDecodeError, IOError) as e:
         logging.error(f"Error loading token from {token_path}: {e}")
     return None
 
 def save_token(token_data, token_file=None):
     """Save the token data to the token file."""
     token_path = get_token_path(token_file)
+    # Record when the tokens expire, so that the next calls and runs can reuse them while they are valid
+    now = time.time()
+    if 'expires_in' in token_data:
+        token_data['expires_at'] = now + token_data['expires_in']
+    if 'refresh_expires_in' in token_data:
+        token_data['refresh_expires_at'] = now + token_data['refresh_expires_in']
     try:
-        with open(token_path, 'w') as f:
-            json.dump(token_data, f)
+        # Write a temporary file and rename it, so that the token file is never read half written
+        tmp_path = f"{token_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps(token_data))
+        os.replace(tmp_path, token_path)
+        _CACHED_TOKENS[token_path] = token_data
         return True
     except IOError as e:
         logging.error(f"Error saving token to {token_path}: {e}")
@@ -68,7 +92,7 @@ def generate_token(token_file=None):
         return None
     
     try:
-        response = requests.post(
+        response = SESSION.post(
             TOKEN_URL,
             data={
                 "client_id": "cdse-public",
@@ -97,14 +121,19 @@ def generate_token(token_file=None):
 
 def refresh_token(token_data=None, token_file=None):
     """Refresh an existing token using the refresh token."""
+    # The cached token is not reused anymore, it may have been rejected
+    _CACHED_TOKENS.pop(get_token_path(token_file), None)
     if token_data is None:
         token_data = load_token(token_file)
         
     if not token_data or 'refresh_token' not in token_data:
         return generate_token(token_file)
+    if token_data.get('refresh_expires_at', float('inf')) <= time.time():
+        logging.warning("Refresh token expired. Generating a new token...")
+        return generate_token(token_file)
     
     try:
-        response = requests.post(
+        response = SESSION.post(
             TOKEN_URL,
             data={
                 "client_id": "cdse-public",
@@ -129,14 +158,42 @@ def refresh_token(token_data=None, token_file=None):
 
 def ensure_valid_token(token_file=None):
     """Ensure a valid token is available, generating or refreshing if needed."""
-    token_data = load_token(token_file)
-    if token_data is None:
-        logging.warning("No token found. Generating a new token...")
-        return generate_token(token_file)
-    else:
+    # Reuse the cached token while it is valid, without taking the lock or reading the file
+    token_path = get_token_path(token_file)
+    token_data = _CACHED_TOKENS.get(token_path)
+    if is_token_valid(token_data):
+        return token_data
+    
+    with _TOKEN_LOCK:
+        token_data = load_token(token_file)
+        if token_data is None:
+            logging.warning("No token found. Generating a new token...")
+            return generate_token(token_file)
+        # Reuse the saved token while it is valid, instead of refreshing it on every call
+        if is_token_valid(token_data):
+            _CACHED_TOKENS[token_path] = token_data
+            return token_data
         logging.warning("Refreshing token...")
         return refresh_token(token_data, token_file)
 
+def can_get_token_without_prompt(token_file=None):
+    """Check if a valid token can be obtained without prompting the user for credentials."""
+    token_data = load_token(token_file)
+    if is_token_valid(token_data):
+        return True
+    if token_data and 'refresh_token' in token_data and token_data.get('refresh_expires_at', float('inf')) > time.time():
+        return True
+    return bool(os.environ.get('COPERNICUS_USERNAME') and os.environ.get('COPERNICUS_PASSWORD'))
+
+def refresh_rejected_token(rejected_access_token, token_file=None):
+    """Refresh a token rejected by the API, once for all the concurrent requests that were using it."""
+    with _TOKEN_LOCK:
+        # Another request may already have replaced the rejected token
+        token_data = _CACHED_TOKENS.get(get_token_path(token_file)) or load_token(token_file)
+        if is_token_valid(token_data) and token_data.get('access_token') != rejected_access_token:
+            return token_data
+        return refresh_token(token_data, token_file)
+
 def get_access_token(token_file=None):
     """Get a valid access token."""
     token_data = ensure_valid_token(token_file)